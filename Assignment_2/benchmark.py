@@ -0,0 +1,270 @@
+import argparse
+import bisect
+import itertools
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import raft_pb2
+from raft import cluster_addresses
+from raft_client import RaftClient, RaftClientError
+
+# Runs a YCSB-style workload against a Raft cluster started on localhost (see --help)
+
+WORKLOADS = {  # Fraction of GET operations, as in the YCSB core workloads
+    "A": 0.5,  # Update heavy
+    "B": 0.95,  # Read mostly
+    "C": 1.0,  # Read only
+    "W": 0.0,  # Write only
+}
+CONSISTENCY = {
+    "linearizable": raft_pb2.LINEARIZABLE,
+    "read_index": raft_pb2.READ_INDEX,
+    "bounded_staleness": raft_pb2.BOUNDED_STALENESS,
+}
+LEADER_WAIT_TIMEOUT = 60  # Time in seconds to wait for the cluster to elect its first leaders
+
+
+class UniformKeys:
+    def __init__(self, num_keys):
+        self.num_keys = num_keys
+
+    def next(self, rng):
+        return rng.randrange(self.num_keys)
+
+
+class ZipfianKeys:
+    # Key i is chosen with probability proportional to 1 / (i + 1) ** theta. Keys are scattered
+    # so the popular ones do not all hash to the same Raft group.
+    def __init__(self, num_keys, theta):
+        self.cumulative = list(itertools.accumulate(1.0 / (i + 1) ** theta for i in range(num_keys)))
+        self.order = list(range(num_keys))
+        random.Random(0).shuffle(self.order)
+
+    def next(self, rng):
+        rank = bisect.bisect_left(self.cumulative, rng.random() * self.cumulative[-1])
+        return self.order[min(rank, len(self.order) - 1)]
+
+
+class Cluster:
+    def __init__(self, num_nodes, num_groups, num_learners, engine, directory):
+        self.addresses = cluster_addresses(num_nodes, local=True)
+        self.processes = {}
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), engine)
+        for node_id in self.addresses:
+            command = [sys.executable, script, str(node_id), str(num_nodes)]
+            if num_groups > 1:
+                command.append(str(num_groups))
+            command.append("--local")
+            if num_learners:
+                learner_ids = range(num_nodes - num_learners, num_nodes)
+                command.append("--learners=" + ",".join(str(learner_id) for learner_id in learner_ids))
+            self.processes[node_id] = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL,
+                                                       stderr=subprocess.DEVNULL)
+
+    def kill(self, node_id):
+        self.processes[node_id].kill()
+
+    def stop_node(self, node_id):
+        # Graceful shutdown, a leader first hands leadership to another node
+        self.processes[node_id].send_signal(signal.SIGINT)
+
+    def stop(self):
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {"GET": [], "SET": []}
+        self.errors = {"GET": 0, "SET": 0}
+        self.completions = []  # (finish time, operation, succeeded)
+
+    def record(self, operation, start, end, succeeded):
+        with self.lock:
+            if succeeded:
+                self.latencies[operation].append(end - start)
+            else:
+                self.errors[operation] += 1
+            self.completions.append((end, operation, succeeded))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def print_histogram(latencies):
+    # Power of two buckets in microseconds
+    buckets = {}
+    for latency in latencies:
+        bucket = max(0, int(latency * 1e6)).bit_length()
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+    widest = max(buckets.values())
+    for bucket in sorted(buckets):
+        low, high = (1 << (bucket - 1)) if bucket else 0, 1 << bucket
+        bar = "#" * max(1, round(40 * buckets[bucket] / widest))
+        print(f"    {low / 1000:>10.3f} - {high / 1000:<10.3f} ms {buckets[bucket]:>8} {bar}")
+
+
+def worker(args, client, keys, read_ratio, consistency, recorder, stop_time, seed):
+    rng = random.Random(seed)
+    value = "v" * args.value_size
+    while time.time() < stop_time:
+        key = f"key{keys.next(rng)}"
+        operation = "GET" if rng.random() < read_ratio else "SET"
+        start = time.time()
+        try:
+            if operation == "GET":
+                client.get(key, consistency)
+            else:
+                client.set(key, value)
+            succeeded = True
+        except RaftClientError:
+            succeeded = False
+        recorder.record(operation, start, time.time(), succeeded)
+
+
+def wait_for_leaders(addresses, num_groups):
+    # Returns the leader of every group once each of them has committed a write
+    with RaftClient(addresses, num_groups, timeout=LEADER_WAIT_TIMEOUT) as client:
+        for group in range(num_groups):
+            try:
+                client.set(client.key_in_group(group), "0")
+            except RaftClientError:
+                return None
+        return dict(client.leaders)
+
+
+def kill_leader(cluster, client, failover, graceful):
+    leader_id = client.leaders.get(0)
+    if leader_id is None:
+        print("Could not stop the leader, no leader known.")
+        return
+    kill_time = time.time()
+    if graceful:
+        cluster.stop_node(leader_id)
+    else:
+        cluster.kill(leader_id)
+    failover["action"] = "stopping" if graceful else "killing"
+    print(f"{failover['action'].capitalize()} leader Node {leader_id} at {kill_time - failover['start']:.1f}s.")
+    failover["kill_time"] = kill_time
+    failover["leader"] = leader_id
+
+
+def report(recorder, elapsed, failover):
+    print()
+    total = sum(len(values) for values in recorder.latencies.values())
+    print(f"Completed {total} operations in {elapsed:.1f}s: {total / elapsed:.1f} ops/s")
+    for operation, latencies in recorder.latencies.items():
+        if not latencies and not recorder.errors[operation]:
+            continue
+        latencies.sort()
+        print(f"{operation}: {len(latencies)} ok, {recorder.errors[operation]} failed, "
+              f"p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms, "
+              f"p999 {percentile(latencies, 0.999) * 1000:.2f} ms, max {latencies[-1] * 1000 if latencies else 0:.2f} ms")
+        if latencies:
+            print_histogram(latencies)
+    if "kill_time" in failover:
+        kill_time = failover["kill_time"]
+        writes_after = [end for end, operation, succeeded in recorder.completions
+                        if succeeded and operation == "SET" and end > kill_time]
+        completions = sorted(end for end, operation, succeeded in recorder.completions if succeeded)
+        gaps = [later - earlier for earlier, later in zip(completions, completions[1:]) if later > kill_time]
+        print(f"Failover after {failover['action']} Node {failover['leader']}:")
+        if writes_after:
+            print(f"    first successful write {min(writes_after) - kill_time:.2f}s later")
+        else:
+            print("    no write succeeded afterwards")
+        if gaps:
+            print(f"    longest gap between completed operations {max(gaps):.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a local Raft cluster with a YCSB-style workload.")
+    parser.add_argument("--nodes", type=int, default=3, help="number of nodes to launch")
+    parser.add_argument("--groups", type=int, default=1, help="number of Raft groups per node (raft.py only)")
+    parser.add_argument("--learners", type=int, default=0, help="how many of the nodes are non-voting learners")
+    parser.add_argument("--engine", default="raft.py", choices=["raft.py", "raft_aio.py"])
+    parser.add_argument("--no-launch", action="store_true", help="use a cluster already running with --local")
+    parser.add_argument("--workload", default="A", choices=sorted(WORKLOADS), help="YCSB read/write mix")
+    parser.add_argument("--read-ratio", type=float, help="fraction of GETs, overrides --workload")
+    parser.add_argument("--consistency", default="linearizable", choices=sorted(CONSISTENCY))
+    parser.add_argument("--keys", type=int, default=1000, help="number of distinct keys")
+    parser.add_argument("--distribution", default="zipfian", choices=["uniform", "zipfian"])
+    parser.add_argument("--zipf-theta", type=float, default=0.99)
+    parser.add_argument("--value-size", type=int, default=16, help="value size in bytes")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of client threads")
+    parser.add_argument("--duration", type=float, default=30, help="run time in seconds")
+    parser.add_argument("--op-timeout", type=float, default=60, help="time in seconds before an operation is failed")
+    parser.add_argument("--kill-leader-at", type=float, help="kill the leader this many seconds into the run")
+    parser.add_argument("--stop-leader-at", type=float,
+                        help="stop the leader gracefully (with leadership transfer) this many seconds into the run")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if args.groups > 1 and args.engine == "raft_aio.py":
+        parser.error("--groups needs --engine raft.py, raft_aio.py runs a single Raft group")
+
+    read_ratio = args.read_ratio if args.read_ratio is not None else WORKLOADS[args.workload]
+    if args.distribution == "zipfian":
+        keys = ZipfianKeys(args.keys, args.zipf_theta)
+    else:
+        keys = UniformKeys(args.keys)
+
+    cluster = None
+    if not args.no_launch:
+        directory = tempfile.mkdtemp(prefix="raft_benchmark_")
+        print(f"Starting {args.nodes} nodes ({args.engine}) in {directory}")
+        cluster = Cluster(args.nodes, args.groups, args.learners, args.engine, directory)
+    addresses = cluster_addresses(args.nodes, local=True)
+    clients = [RaftClient(addresses, args.groups, timeout=args.op_timeout) for _ in range(args.concurrency)]
+    try:
+        leaders = wait_for_leaders(addresses, args.groups)
+        if leaders is None:
+            print("No leader elected, giving up.")
+            return
+        for client in clients:
+            client.leaders = dict(leaders)
+        print(f"Running workload: {read_ratio:.0%} reads, {args.distribution} over {args.keys} keys, "
+              f"{args.concurrency} clients for {args.duration}s")
+
+        recorder = Recorder()
+        failover = {"start": time.time()}
+        stop_time = failover["start"] + args.duration
+        threads = [threading.Thread(target=worker, args=(args, client, keys, read_ratio, CONSISTENCY[args.consistency],
+                                                         recorder, stop_time, args.seed + i))
+                   for i, client in enumerate(clients)]
+        for thread in threads:
+            thread.start()
+        stop_at = args.kill_leader_at if args.kill_leader_at is not None else args.stop_leader_at
+        if stop_at is not None:
+            if cluster is None:
+                print("--kill-leader-at and --stop-leader-at need a launched cluster, ignoring them.")
+            else:
+                time.sleep(stop_at)
+                kill_leader(cluster, clients[0], failover, graceful=args.kill_leader_at is None)
+        for thread in threads:
+            thread.join()
+        report(recorder, time.time() - failover["start"], failover)
+    finally:
+        for client in clients:
+            client.close()
+        if cluster is not None:
+            cluster.stop()
+            shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,8 @@
-import grpc
-import raft_pb2
-import raft_pb2_grpc
 import signal
 import os
+import sys
+from raft import cluster_addresses
+from raft_client import RaftClient, RaftClientError
 
 def signal_handler(signal, frame):
     print("\nProgram exiting gracefully")
@@ -10,52 +10,36 @@ def signal_handler(signal, frame):
 
 signal.signal(signal.SIGINT, signal_handler)
 
-def run_client(node_addresses):
-    leader_id = None
-    while True:
-        leader_found = False
+def run_client(node_addresses, num_groups=1):
+    with RaftClient(node_addresses, num_groups) as client:
+        leader_id = client.discover_leader("__leader__")
         if leader_id is None:
-            for node_id, node_address in node_addresses.items():
-                with grpc.insecure_channel(node_address) as channel:
-                    stub = raft_pb2_grpc.RaftStub(channel)
-                    try:
-                        response = stub.ServeClient(raft_pb2.ServeClientArgs(Request="GET __leader__"), timeout=5)
-                        if response.Success:
-                            leader_id = response.LeaderID
-                            print(f"Connected to leader: {leader_id}")
-                            leader_found = True
-                            break
-                    except grpc.RpcError as e:
-                        print("Leader is unavailable. Trying again...")
-                        continue
-            if not leader_found:
-                print("No leader found in the network. Exiting.")
-                return
+            print("No leader found in the network yet. Requests will be retried until one is elected.")
         else:
+            print(f"Connected to leader: {leader_id}")
+        while True:
+            request = input("Enter command (GET <key>, SET <key> <value> or SCAN <start> [end] [limit]): ")
             try:
-                with grpc.insecure_channel(node_addresses[int(leader_id)]) as channel:
-                    stub = raft_pb2_grpc.RaftStub(channel)
-                    while True:
-                        request = input("Enter command (GET <key> or SET <key> <value>): ")
-                        try:
-                            response = stub.ServeClient(raft_pb2.ServeClientArgs(Request=request), timeout=5)
-                            if response.Success:
-                                print(f"Response: {response.Data}")
-                            else:
-                                print(f"Leader changed. Connecting to new leader...")
-                                leader_id = response.LeaderID
-                                break
-                        except grpc.RpcError as e:
-                            print("Leader is unavailable. Trying again...")
-                            leader_id = None
-                            break
-            except:
-                leader_id = None
+                parts = request.split()
+                if parts and parts[0] == "SCAN":
+                    if len(parts) < 2:
+                        raise ValueError(f"Invalid command: {request}")
+                    end = parts[2] if len(parts) > 2 else ""
+                    limit = int(parts[3]) if len(parts) > 3 else 0
+                    for key, value in client.scan(parts[1], end, limit):
+                        print(f"{key} {value}")
+                    continue
+                response = client.execute(request)
+                print(f"Response: {response.Data}")
+            except ValueError as e:
+                print(e)
+            except RaftClientError as e:
+                print(f"Leader is unavailable: {e}")
 
 if __name__ == "__main__":
     N = int(input("Enter the number of nodes: "))
-    node_addresses = {i: f"10.190.0.{i+2}:5005{i}" for i in range(N)}
+    node_addresses = cluster_addresses(N, local="--local" in sys.argv)
     try:
         run_client(node_addresses)
-    except SystemExit:
-        pass
\ No newline at end of file
+    except (SystemExit, EOFError):
+        pass
@@ -0,0 +1,75 @@
+import datetime
+import itertools
+import queue
+import sys
+import threading
+import time
+
+# Verbosity levels, a message is written only if its level is at least DUMP_LOG_LEVEL
+DEBUG = 10
+INFO = 20
+WARNING = 30
+
+DUMP_LOG_LEVEL = DEBUG  # Lowest level written to the dump file
+DUMP_SAMPLE_EVERY = 1  # Only every n-th sampled (per-entry) message is written
+DUMP_QUEUE_SIZE = 10000  # Messages waiting for the writer thread, further messages are dropped
+DUMP_BATCH_SIZE = 512  # Maximum number of messages written with a single flush
+DUMP_TO_STDOUT = True  # Also print every written message
+
+class DumpLogger:
+    def __init__(self, path, level=None, sample_every=None, to_stdout=None):
+        self.level = DUMP_LOG_LEVEL if level is None else level
+        self.sample_every = DUMP_SAMPLE_EVERY if sample_every is None else sample_every
+        self.to_stdout = DUMP_TO_STDOUT if to_stdout is None else to_stdout
+        self.file = open(path, "a")
+        self.queue = queue.Queue(maxsize=DUMP_QUEUE_SIZE)
+        self.sample_counter = itertools.count()
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer.start()
+
+    def log(self, message, level=INFO, sampled=False):
+        # Called on the hot path, so only the cheap checks and the enqueue happen here.
+        # Formatting, printing and writing are done by the writer thread.
+        if level < self.level:
+            return
+        if sampled and self.sample_every > 1 and next(self.sample_counter) % self.sample_every:
+            return
+        try:
+            self.queue.put_nowait((time.time(), message))
+        except queue.Full:
+            self.dropped += 1
+
+    def writer_loop(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < DUMP_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = None in batch
+            lines = [self.format(timestamp, message) for timestamp, message in filter(None, batch)]
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(self.format(time.time(), f"Dump queue full, dropped {dropped} messages."))
+            text = "".join(lines)
+            if self.to_stdout:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            self.file.write(text)
+            self.file.flush()
+            if closing:
+                return
+
+    def format(self, timestamp, message):
+        timestamp = datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        return f"[{timestamp}] {message}\n"
+
+    def close(self):
+        # Writes everything still queued before closing the file
+        if not self.writer.is_alive():
+            return
+        self.queue.put(None)
+        self.writer.join()
+        self.file.close()
@@ -0,0 +1,27 @@
+import bisect
+
+class KeyValueStore(dict):
+    # The replicated key-value state machine. A sorted list of the keys is kept next to the dict
+    # so key ranges can be scanned in order. Only item assignment and deletion keep the index up
+    # to date, which is all the state machine uses.
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.sorted_keys = sorted(self)
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            bisect.insort(self.sorted_keys, key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        del self.sorted_keys[bisect.bisect_left(self.sorted_keys, key)]
+
+    def scan(self, start, end, limit=0):
+        # Returns the (key, value) pairs with start <= key < end in key order. An empty end
+        # means no upper bound and a limit of 0 means no limit.
+        first = bisect.bisect_left(self.sorted_keys, start)
+        last = bisect.bisect_left(self.sorted_keys, end) if end else len(self.sorted_keys)
+        if limit:
+            last = min(last, first + limit)
+        return [(key, dict.__getitem__(self, key)) for key in self.sorted_keys[first:last]]
@@ -0,0 +1,114 @@
+import array
+import bisect
+import raft_pb2
+
+LOG_READ_CHUNK = 1024  # Entries decoded at a time when iterating over the log
+
+# Every entry is framed as the entries field of AppendEntriesArgs, so the bytes of a run of
+# entries are also the encoding of an AppendEntriesArgs that carries just those entries
+ENTRY_TAG = bytes([raft_pb2.AppendEntriesArgs.DESCRIPTOR.fields_by_name["entries"].number << 3 | 2])
+
+
+def encode_varint(value):
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append(value & 0x7f | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+class LogStore:
+    # The in-memory Raft log, indexed from 0. Rather than a list of LogEntry messages (over 500
+    # bytes each) the serialized entries are packed back to back into one bytearray, and their
+    # terms and offsets are kept in arrays next to it. Entries are only decoded when read.
+    def __init__(self):
+        self.terms = array.array("i")
+        self.offsets = array.array("Q", [0])  # Start of every entry followed by the end of the last one
+        self.header_sizes = array.array("B")  # Framing bytes in front of every serialized entry
+        self.data = bytearray()
+        self.base = 0  # Offset of data[0], so dropping entries from the front leaves the offsets valid
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, end, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("LogStore slices do not support a step")
+            if start >= end:
+                return []
+            request = raft_pb2.AppendEntriesArgs()
+            self.read_into(request, start, end)
+            return list(request.entries)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("log index out of range")
+        return raft_pb2.LogEntry.FromString(self.payload(index))
+
+    def __iter__(self):
+        return self.entries(0, len(self))
+
+    def entries(self, start, end):
+        # Decodes the entries in chunks, so scanning a long log never holds all of them at once
+        for chunk_start in range(start, end, LOG_READ_CHUNK):
+            yield from self[chunk_start:min(end, chunk_start + LOG_READ_CHUNK)]
+
+    def term(self, index):
+        return self.terms[index]
+
+    def payload(self, index):
+        # The serialized LogEntry, without its framing
+        start = self.offsets[index] - self.base + self.header_sizes[index]
+        return bytes(self.data[start:self.offsets[index + 1] - self.base])
+
+    def payloads(self, start, end):
+        return [self.payload(index) for index in range(start, end)]
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append_payload(entry.term, entry.SerializeToString())
+
+    def extend_payloads(self, terms, payloads):
+        # Appends entries that are already serialized, such as those loaded from the WAL, without decoding them
+        for term, payload in zip(terms, payloads):
+            self.append_payload(term, payload)
+
+    def append_payload(self, term, payload):
+        header = ENTRY_TAG + encode_varint(len(payload))
+        self.data += header
+        self.data += payload
+        self.terms.append(term)
+        self.header_sizes.append(len(header))
+        self.offsets.append(self.offsets[-1] + len(header) + len(payload))
+
+    def read_into(self, request, start, end):
+        # Appends entries start..end-1 to an AppendEntriesArgs by parsing the buffer in place
+        with memoryview(self.data)[self.offsets[start] - self.base:self.offsets[end] - self.base] as view:
+            request.MergeFromString(view)
+
+    def batch_end(self, start, max_entries, max_bytes):
+        # End of the longest run of entries from start within both limits, at least one entry long
+        end = min(len(self), start + max_entries)
+        fits = bisect.bisect_right(self.offsets, self.offsets[start] + max_bytes, start, end + 1) - 1
+        return max(fits, min(start + 1, end))
+
+    def truncate(self, length):
+        # Keeps the first length entries
+        del self.data[self.offsets[length] - self.base:]
+        del self.terms[length:]
+        del self.header_sizes[length:]
+        del self.offsets[length + 1:]
+
+    def drop_prefix(self, count):
+        del self.data[:self.offsets[count] - self.base]
+        self.base = self.offsets[count]
+        del self.terms[:count]
+        del self.header_sizes[:count]
+        del self.offsets[:count]
+
+    def memory_size(self):
+        return len(self.data) + self.terms.itemsize * len(self.terms) + \
+            self.offsets.itemsize * len(self.offsets) + len(self.header_sizes)
@@ -0,0 +1,70 @@
+import bisect
+import sys
+import threading
+import grpc
+import raft_pb2
+import raft_pb2_grpc
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+class Metrics:
+    # Counters and latency histograms of one Raft node, keyed by name and a sorted tuple of labels.
+    # Gauges such as the log size are read from the node when the metrics are collected.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}  # Key -> [bucket counts, sum, count]
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def samples(self, **extra_labels):
+        # Returns Metric messages, histograms are expanded into cumulative _bucket, _sum and _count series
+        samples = []
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples.append(metric(name, value, dict(labels, **extra_labels)))
+            for (name, labels), (buckets, total, count) in self.histograms.items():
+                labels = dict(labels, **extra_labels)
+                cumulative = 0
+                for bound, bucket_count in zip(LATENCY_BUCKETS + ["+Inf"], buckets):
+                    cumulative += bucket_count
+                    samples.append(metric(f"{name}_bucket", cumulative, dict(labels, le=str(bound))))
+                samples.append(metric(f"{name}_sum", total, labels))
+                samples.append(metric(f"{name}_count", count, labels))
+        return samples
+
+def metric(name, value, labels=None):
+    return raft_pb2.Metric(name=name, value=value, labels={key: str(value) for key, value in (labels or {}).items()})
+
+def render_text(metrics):
+    # Prometheus text exposition format
+    lines = []
+    for sample in metrics:
+        labels = ",".join(f'{key}="{value}"' for key, value in sorted(sample.labels.items()))
+        lines.append(f"{sample.name}{{{labels}}} {sample.value:g}" if labels else f"{sample.name} {sample.value:g}")
+    return "\n".join(lines) + "\n"
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python metrics.py <node_address>")
+        sys.exit(1)
+    with grpc.insecure_channel(sys.argv[1]) as channel:
+        reply = raft_pb2_grpc.RaftStub(channel).GetMetrics(raft_pb2.GetMetricsArgs(), timeout=5)
+    sys.stdout.write(render_text(reply.metrics))
+
+if __name__ == "__main__":
+    main()
@@ -7,14 +7,53 @@ import threading
 import os
 import sys
 from concurrent import futures
-import datetime
 import signal
+import heapq
+import collections
+import itertools
+import functools
+import queue
+import zlib
+from wal import WriteAheadLog, atomic_write, save_metadata, sync_directory, write_file
+from dump_logger import DumpLogger, DEBUG, INFO, WARNING
+from metrics import Metrics, metric
+from kv_store import KeyValueStore
+from log_store import LogStore
 
 # Constants
 HEARTBEAT_INTERVAL = 1.0  # Heartbeat interval in seconds
 ELECTION_TIMEOUT_MIN = 5.0  # Minimum election timeout in seconds
 ELECTION_TIMEOUT_MAX = 10.0  # Maximum election timeout in seconds
 LEASE_DURATION = 10  # Leader lease duration in seconds
+GROUP_COMMIT_MAX_BATCH = 64  # Maximum number of client writes flushed with a single fsync
+GROUP_COMMIT_MAX_DELAY = 0.005  # Time in seconds to wait for more client writes before flushing a batch
+SNAPSHOT_THRESHOLD = 1000  # Minimum number of applied entries after which the log is compacted into a snapshot
+SNAPSHOT_CHUNK_SIZE = 1024 * 1024  # Maximum snapshot bytes sent in a single InstallSnapshot RPC
+APPEND_ENTRIES_MAX_ENTRIES = 512  # Maximum number of log entries sent in a single AppendEntries RPC
+APPEND_ENTRIES_MAX_BYTES = 1024 * 1024  # Maximum serialized entry bytes in a single AppendEntries RPC
+APPEND_ENTRIES_MAX_IN_FLIGHT = 4  # Maximum number of unanswered AppendEntries RPCs per follower
+APPEND_ENTRIES_REORDER_WAIT = 0.05  # Time in seconds a follower waits for an earlier pipelined request that was overtaken
+READ_INDEX_TIMEOUT = 2.0  # Time in seconds a follower waits to apply the read index before failing the read
+DEFAULT_MAX_STALENESS = HEARTBEAT_INTERVAL * 2  # Staleness bound in seconds used when the client does not set one
+STREAM_MAX_IN_FLIGHT = 1024  # Maximum number of unanswered operations on a ServeClientStream
+SERVER_THREADS = 10  # gRPC server threads per Raft group
+STREAM_THREADS = 256  # Threads per node serving Watch and ServeClientStream calls, apart from the server threads
+SCAN_CHUNK_SIZE = 256  # Number of key-value pairs sent in each ScanReply message
+WATCH_CHUNK_SIZE = 256  # Maximum number of events sent in each WatchReply message
+WATCH_MAX_PENDING_EVENTS = 10000  # A watch with more unsent events than this is closed, the client resumes it
+WATCH_PROGRESS_INTERVAL = 5.0  # Time in seconds after which an idle watch is sent a reply without events
+TRANSFER_TIMEOUT = ELECTION_TIMEOUT_MIN  # Time in seconds a leadership transfer may take before it is given up
+TRANSFER_POLL_INTERVAL = 0.01  # Time in seconds between checks on the progress of a leadership transfer
+PROMOTE_MAX_LAG = 100  # A learner is only promoted once it is at most this many entries behind the leader
+LOCAL_BASE_PORT = 50050  # Node i listens on localhost:LOCAL_BASE_PORT + i when started with --local
+PROMOTE_PREFIX = raft_pb2.LogEntry(operation="PROMOTE").SerializeToString()  # Every serialized PROMOTE entry starts with these bytes
+
+# Peer channels are kept open for the lifetime of the node, gRPC reconnects them with these backoff bounds
+CHANNEL_OPTIONS = [
+    ("grpc.initial_reconnect_backoff_ms", 100),
+    ("grpc.min_reconnect_backoff_ms", 100),
+    ("grpc.max_reconnect_backoff_ms", 2000),
+]
 
 # Raft node states
 FOLLOWER = 0
@@ -22,13 +61,30 @@ CANDIDATE = 1
 LEADER = 2
 
 class RaftNode(raft_pb2_grpc.RaftServicer):
-    def __init__(self, node_id, node_addresses):
+    def __init__(self, node_id, node_addresses, group_id=None, learner_ids=()):
         self.node_id = node_id
         self.node_addresses = node_addresses
+        # Learners receive the log but do not vote. A PROMOTE entry turns one into a voter, it takes
+        # effect as soon as it is in the log and snapshots record the learners promoted so far.
+        self.initial_learners = set(learner_ids)
+        self.snapshot_promoted = set()
+        self.log_promotions = []  # (index, node id) of the PROMOTE entries in the log, in log order
+        self.learners = set(learner_ids)
+        # group_id is only set when the process hosts several Raft groups (see MultiRaftServer)
+        self.group_id = group_id
+        if group_id is None:
+            self.data_dir = f"logs_node_{node_id}"
+        else:
+            self.data_dir = f"logs_node_{node_id}/group_{group_id}"
         self.state = FOLLOWER
         self.current_term = 0
         self.voted_for = None
-        self.log = []
+        self.log = LogStore()
+        self.log_offset = 0  # Index of the last entry covered by the snapshot
+        self.snapshot_term = 0
+        self.snapshot_buffer = bytearray()
+        self.snapshot_data = None  # The serialized snapshot up to log_offset, sent to lagging followers
+        self.snapshot_in_progress = False
         self.commit_length = 0
         self.current_leader = None
         self.votes_received = set()
@@ -40,25 +96,41 @@ class RaftNode(raft_pb2_grpc.RaftServicer):
         self.old_leader_lease_timeout = 0
         self.heartbeat_success_count = set()
         self.lease_start_time = 0
-        self.data_store = {}
+        self.last_leader_contact = 0
+        self.transfer_target = None  # Set while this leader hands leadership to another node
+        self.random = random.Random()  # Draws the election timeouts, the simulator seeds it
+        self.data_store = KeyValueStore()
+        self.watchers = set()  # Watch streams of this node, guarded by log_lock
         self.timer_lock = threading.Lock()
+        self.log_lock = threading.RLock()
+        self.log_extended = threading.Condition(self.log_lock)
+        self.channels = {}
+        self.stubs = {}
+        self.channel_lock = threading.Lock()
+        self.replicate_events = {}
+        self.pending_writes = []
+        self.commit_waiters = []  # Heap of (log index, id, future, leader_only)
+        self.commit_waiter_ids = itertools.count()
+        self.commit_waiters_lock = threading.Lock()
+        self.group_commit_cond = threading.Condition()
+        self.metrics = Metrics()
+        self.membership_lock = threading.Lock()
+        self.wal = WriteAheadLog(f"{self.data_dir}/wal")
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.dump_logger = DumpLogger(f"{self.data_dir}/dump.txt")
+        self.recovery_seconds = 0
         self.load_state()
-        os.makedirs(f"logs_node_{self.node_id}", exist_ok=True)
-        try:
-            self.dump_file = open(f"logs_node_{self.node_id}/dump.txt", "a")
-        except FileNotFoundError:
-            self.dump_file = open(f"logs_node_{self.node_id}/dump.txt", "w")
+        self.spawn(self.group_commit_loop)
 
-    def write_to_dump_file(self, message):
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-        log_message = f"[{timestamp}] {message}"
-        print(log_message)
-        self.dump_file.write(log_message + "\n")
-        self.dump_file.flush()
+    def write_to_dump_file(self, message, level=INFO, sampled=False):
+        # Messages logged for every entry or heartbeat pass sampled=True so they can be thinned out
+        if self.group_id is not None:
+            message = f"[Group {self.group_id}] {message}"
+        self.dump_logger.log(message, level, sampled)
 
     def load_state(self):
         try:
-            with open(f"logs_node_{self.node_id}/metadata.txt", "r") as f:
+            with open(f"{self.data_dir}/metadata.txt", "r") as f:
                 lines = f.readlines()
                 for line in lines:
                     if line.startswith("commit_length:"):
@@ -66,55 +138,280 @@ class RaftNode(raft_pb2_grpc.RaftServicer):
                     elif line.startswith("current_term:"):
                         self.current_term = int(line.split(":")[1].strip())
                     elif line.startswith("voted_for:"):
-                        self.voted_for = line.split(":")[1].strip() or None
+                        voted_for = line.split(":")[1].strip()
+                        self.voted_for = int(voted_for) if voted_for else None
+        except FileNotFoundError:
+            pass
+        self.saved_vote = (self.current_term, self.voted_for)
+
+        start = time.time()
+        snapshot = self.load_snapshot()
+        if snapshot is not None:
+            self.log_offset = snapshot.last_included_index
+            self.snapshot_term = snapshot.last_included_term
+            self.data_store = KeyValueStore(snapshot.data)
+            self.snapshot_promoted = set(snapshot.promoted)
+            self.commit_length = max(self.commit_length, self.log_offset)
 
-            with open(f"logs_node_{self.node_id}/logs.txt", "r") as f:
+        snapshot_loaded = time.time()
+        # Only the tail after the snapshot is loaded, the WAL records are copied into the log without being parsed
+        terms, payloads = self.wal.load(self.log_offset)
+        self.log.extend_payloads(terms, payloads)
+        self.log_promotions = [(index, int(raft_pb2.LogEntry.FromString(payload).key))
+                               for index, payload in enumerate(payloads, self.log_offset + 1)
+                               if payload.startswith(PROMOTE_PREFIX)]
+        if snapshot is None and not self.log:
+            self.import_legacy_log()
+        self.learners = self.initial_learners - self.promoted_up_to(self.last_log_index())
+        self.commit_length = min(self.commit_length, self.last_log_index())
+        log_loaded = time.time()
+        for entry in self.log.entries(0, self.commit_length - self.log_offset):
+            self.apply_entry(entry)
+        self.recovery_seconds = time.time() - start
+        self.write_to_dump_file(f"Node {self.node_id} recovered in {self.recovery_seconds:.3f}s: snapshot up to index "
+                                f"{self.log_offset} loaded in {snapshot_loaded - start:.3f}s, {len(self.log)} log entries "
+                                f"loaded in {log_loaded - snapshot_loaded:.3f}s and {self.commit_length - self.log_offset} "
+                                f"committed entries applied in {time.time() - log_loaded:.3f}s.")
+
+    def import_legacy_log(self):
+        # Nodes started before the WAL existed kept their log in logs.txt
+        legacy_path = f"{self.data_dir}/logs.txt"
+        try:
+            with open(legacy_path, "r") as f:
                 lines = f.readlines()
-                for line in lines:
-                    parts = line.strip().split(" ")
-                    if parts[0] == "NO-OP":
-                        term = int(parts[1])
-                        self.log.append(raft_pb2.LogEntry(operation="NO-OP", term=term))
-                    elif parts[0] == "SET":
-                        key = parts[1]
-                        value = parts[2]
-                        term = int(parts[3])
-                        self.log.append(raft_pb2.LogEntry(operation="SET", key=key, value=value, term=term))
-                        if len(self.log) <= self.commit_length:
-                            self.data_store[key] = value
-            
         except FileNotFoundError:
-            pass
+            return
+        entries = []
+        for line in lines:
+            parts = line.strip().split(" ")
+            if parts[0] == "NO-OP":
+                entries.append(raft_pb2.LogEntry(operation="NO-OP", term=int(parts[1])))
+            elif parts[0] == "SET":
+                entries.append(raft_pb2.LogEntry(operation="SET", key=parts[1], value=parts[2], term=int(parts[3])))
+        self.append_to_log(entries)
+        os.replace(legacy_path, legacy_path + ".migrated")
 
     def save_state(self):
-        os.makedirs(f"logs_node_{self.node_id}", exist_ok=True)
-        with open(f"logs_node_{self.node_id}/logs.txt", "w") as f:
-            for entry in self.log:
-                if entry.operation == "NO-OP":
-                    f.write(f"NO-OP {entry.term}\n")
-                elif entry.operation == "SET":
-                    f.write(f"SET {entry.key} {entry.value} {entry.term}\n")
-        with open(f"logs_node_{self.node_id}/metadata.txt", "w") as f:
-            f.write(f"commit_length: {self.commit_length}\n")
-            f.write(f"current_term: {self.current_term}\n")
-            f.write(f"voted_for: {self.voted_for if self.voted_for is not None else ''}\n")
+        # Only the small metadata record is rewritten, log entries go through the WAL. A new term or
+        # vote is fsynced before the node acts on it, a lost commit_length is only learned again.
+        os.makedirs(self.data_dir, exist_ok=True)
+        vote = (self.current_term, self.voted_for)
+        save_metadata(f"{self.data_dir}/metadata.txt", {
+            "commit_length": self.commit_length,
+            "current_term": self.current_term,
+            "voted_for": self.voted_for,
+        }, sync=vote != self.saved_vote)
+        self.saved_vote = vote
+
+    def load_snapshot(self):
+        try:
+            with open(f"{self.data_dir}/snapshot.bin", "rb") as f:
+                self.snapshot_data = f.read()
+        except FileNotFoundError:
+            return None
+        return raft_pb2.Snapshot.FromString(self.snapshot_data)
+
+    def save_snapshot(self, data):
+        os.makedirs(self.data_dir, exist_ok=True)
+        atomic_write(f"{self.data_dir}/snapshot.bin", data, sync=True)
+
+    def last_log_index(self):
+        return self.log_offset + len(self.log)
+
+    def log_term(self, index):
+        if index == self.log_offset:
+            return self.snapshot_term
+        return self.log.term(index - self.log_offset - 1)
+
+    def log_entry(self, index):
+        return self.log[index - self.log_offset - 1]
+
+    def append_to_log(self, entries):
+        with self.log_lock:
+            start = len(self.log)
+            self.log.extend(entries)
+            self.wal.append(self.log_offset + start + 1, self.log.terms[start:], self.log.payloads(start, len(self.log)))
+            self.log_extended.notify_all()
+            promotions = [(index, int(entry.key)) for index, entry in enumerate(entries, self.log_offset + start + 1)
+                          if entry.operation == "PROMOTE"]
+            if promotions:
+                self.log_promotions.extend(promotions)
+                self.update_membership()
+
+    def truncate_log(self, length):
+        with self.log_lock:
+            self.log.truncate(length - self.log_offset)
+            self.wal.truncate(length)
+            self.drop_promotions(lambda index: index > length)
+
+    def drop_promotions(self, dropped):
+        # Keeps log_promotions in step with entries removed from either end of the log
+        kept = [(index, node_id) for index, node_id in self.log_promotions if not dropped(index)]
+        if len(kept) != len(self.log_promotions):
+            self.log_promotions = kept
+            self.update_membership()
+
+    def promoted_up_to(self, index):
+        return self.snapshot_promoted | {node_id for promoted_index, node_id in self.log_promotions if promoted_index <= index}
+
+    def update_membership(self):
+        was_learner = self.is_learner()
+        self.learners = self.initial_learners - self.promoted_up_to(self.last_log_index())
+        if was_learner and not self.is_learner():
+            self.write_to_dump_file(f"Node {self.node_id} promoted from learner to voter.")
+            self.start_election_timer()
+
+    def voters(self):
+        return [node_id for node_id in self.node_addresses if node_id not in self.learners]
+
+    def is_learner(self):
+        return self.node_id in self.learners
+
+    def snapshot_due(self):
+        # A snapshot takes time in proportion to the state, so it is taken at most once every
+        # len(data_store) applied entries, which keeps its cost per entry constant as the state grows
+        return not self.snapshot_in_progress and \
+            self.commit_length - self.log_offset >= max(SNAPSHOT_THRESHOLD, len(self.data_store))
+
+    def take_snapshot(self):
+        # Called with log_lock held, which is only kept to copy the state. write_snapshot serializes
+        # and syncs it in the background, then compacts the log.
+        index = self.commit_length
+        snapshot = raft_pb2.Snapshot(
+            last_included_index=index,
+            last_included_term=self.log_term(index),
+            promoted=sorted(self.promoted_up_to(index))
+        )
+        self.snapshot_in_progress = True
+        self.spawn(self.write_snapshot, snapshot, dict(self.data_store))
+
+    def write_snapshot(self, snapshot, data):
+        self.compact_log(snapshot, self.store_snapshot(snapshot, data))
+
+    def store_snapshot(self, snapshot, data):
+        # Writes the snapshot beside the current one, compact_log puts it in place
+        snapshot.data.update(data)
+        serialized = snapshot.SerializeToString()
+        os.makedirs(self.data_dir, exist_ok=True)
+        write_file(f"{self.data_dir}/snapshot.bin.new", serialized, sync=True)
+        return serialized
+
+    def compact_log(self, snapshot, serialized):
+        index = snapshot.last_included_index
+        path = f"{self.data_dir}/snapshot.bin"
+        with self.log_lock:
+            self.snapshot_in_progress = False
+            if index <= self.log_offset:
+                # A snapshot installed from the leader meanwhile is newer
+                os.remove(path + ".new")
+                return
+            os.replace(path + ".new", path)
+            sync_directory(path)
+            self.snapshot_data = serialized
+            self.snapshot_promoted = set(snapshot.promoted)
+            self.log.drop_prefix(index - self.log_offset)
+            self.log_offset = index
+            self.snapshot_term = snapshot.last_included_term
+            self.wal.compact(index)
+            self.drop_promotions(lambda promoted_index: promoted_index <= index)
+        self.metrics.inc("raft_snapshots_taken_total")
+        self.write_to_dump_file(f"Node {self.node_id} took a snapshot up to index {index}.")
+
+    def install_snapshot(self, snapshot, data):
+        with self.log_lock:
+            index = snapshot.last_included_index
+            if index <= self.commit_length:
+                return
+            self.save_snapshot(data)
+            self.snapshot_data = data
+            if self.log_offset < index <= self.last_log_index() and self.log_term(index) == snapshot.last_included_term:
+                # The follower already has the entries following the snapshot, keep them
+                self.log.drop_prefix(index - self.log_offset)
+                self.wal.compact(index)
+            else:
+                self.log = LogStore()
+                self.wal.truncate(0)
+            self.log_offset = index
+            self.log_promotions = [(promoted_index, node_id) for promoted_index, node_id in self.log_promotions
+                                   if index < promoted_index <= self.last_log_index()]
+            self.snapshot_term = snapshot.last_included_term
+            self.data_store = KeyValueStore(snapshot.data)
+            self.snapshot_promoted = set(snapshot.promoted)
+            self.update_membership()
+            self.commit_length = index
+            for watcher in self.watchers:
+                # The changes up to index were not applied one by one, watchers have to scan again
+                watcher.compacted = True
+                watcher.changed.set()
+            self.save_state()
+        self.notify_commit_waiters()
+        self.metrics.inc("raft_snapshots_installed_total")
+        self.write_to_dump_file(f"Node {self.node_id} installed a snapshot up to index {index}.")
+
+    def get_stub(self, node_id):
+        with self.channel_lock:
+            stub = self.stubs.get(node_id)
+            if stub is None:
+                channel = grpc.insecure_channel(self.node_addresses[node_id], options=CHANNEL_OPTIONS)
+                self.channels[node_id] = channel
+                stub = self.stubs[node_id] = raft_pb2_grpc.RaftStub(channel)
+            return stub
+
+    def close_channels(self):
+        with self.channel_lock:
+            for channel in self.channels.values():
+                channel.close()
+            self.channels = {}
+            self.stubs = {}
+
+    def is_preferred_leader(self):
+        if self.group_id is None:
+            return False
+        node_ids = sorted(self.voters())
+        return node_ids[self.group_id % len(node_ids)] == self.node_id
+
+    def wait_for_log(self, index):
+        # Pipelined AppendEntries may be handled out of order by the server threads. Called with
+        # log_lock held, gives an earlier request that was overtaken a moment to extend the log.
+        self.log_extended.wait_for(lambda: self.last_log_index() >= index, APPEND_ENTRIES_REORDER_WAIT)
+
+    def start_timer(self, delay, callback):
+        # Returns a handle with a cancel() method
+        timer = threading.Timer(delay, callback)
+        timer.start()
+        return timer
+
+    def spawn(self, target, *args):
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+    def create_event(self):
+        return threading.Event()
+
+    def now(self):
+        # Clock for leases, deadlines and staleness checks, in seconds
+        return time.time()
 
     def start_election_timer(self):
+        if self.is_learner():
+            return
         with self.timer_lock:
-            election_timeout = random.uniform(ELECTION_TIMEOUT_MIN, ELECTION_TIMEOUT_MAX)
-            self.election_timer = threading.Timer(election_timeout, self.start_election)
-            self.election_timer.start()
+            election_timeout = self.random.uniform(ELECTION_TIMEOUT_MIN, ELECTION_TIMEOUT_MAX)
+            if self.is_preferred_leader():
+                # Time out before the other replicas so leaders of different groups land on different nodes
+                election_timeout = self.random.uniform(ELECTION_TIMEOUT_MIN / 2, ELECTION_TIMEOUT_MIN)
+            self.election_timer = self.start_timer(election_timeout, self.start_election)
 
     def start_heartbeat_timer(self):
         with self.timer_lock:
-            self.heartbeat_timer = threading.Timer(HEARTBEAT_INTERVAL, self.send_heartbeats)
-            self.heartbeat_timer.start()
+            self.heartbeat_timer = self.start_timer(HEARTBEAT_INTERVAL, self.send_heartbeats)
 
     def start_lease_timer(self):
+        # Renewing replaces the timer under timer_lock so leader_can_read never sees it missing
         with self.timer_lock:
-            self.lease_start_time = time.time()
-            self.lease_timer = threading.Timer(LEASE_DURATION, self.lease_timeout)
-            self.lease_timer.start()
+            if self.lease_timer:
+                self.lease_timer.cancel()
+            self.lease_start_time = self.now()
+            self.lease_timer = self.start_timer(LEASE_DURATION, self.lease_timeout)
 
     def cancel_election_timer(self):
         with self.timer_lock:
@@ -134,65 +431,72 @@ class RaftNode(raft_pb2_grpc.RaftServicer):
                 self.lease_timer.cancel()
                 self.lease_timer = None
 
-    def start_election(self):
+    def start_election(self, leadership_transfer=False):
         # if self.state == LEADER:
         #     return
-        self.write_to_dump_file(f"Node {self.node_id} election timer timed out, Starting election.")
-        self.state = CANDIDATE
-        self.current_term += 1
-        self.voted_for = self.node_id
-        self.votes_received = {self.node_id}
-        last_term = 0
-        if self.log:
-            last_term = self.log[-1].term
-        self.save_state()
+        if self.is_learner():
+            return  # Demoted again after a truncated PROMOTE entry
+        if leadership_transfer:
+            # The old leader gave up its lease before asking us to campaign, there is nothing to wait out
+            self.write_to_dump_file(f"Node {self.node_id} received TimeoutNow, Starting election.")
+            self.old_leader_lease_timeout = 0
+        else:
+            self.write_to_dump_file(f"Node {self.node_id} election timer timed out, Starting election.")
+        self.metrics.inc("raft_elections_started_total")
+        with self.log_lock:
+            self.state = CANDIDATE
+            self.current_term += 1
+            self.voted_for = self.node_id
+            self.votes_received = {self.node_id}
+            term = self.current_term
+            last_term = self.log_term(self.last_log_index())
+            self.save_state()
 
-        threads = []
-        for node_id, node_address in self.node_addresses.items():
+        request = raft_pb2.RequestVoteArgs(
+            group_id=self.group_id or 0,
+            term=term,
+            candidate_id=self.node_id,
+            last_log_index=self.last_log_index(),
+            last_log_term=last_term,
+            leadership_transfer=leadership_transfer
+        )
+        for node_id in self.voters():
             if node_id != self.node_id:
-                thread = self.request_vote_async(node_id, last_term)
-                threads.append(thread)
+                self.spawn(self.request_vote, node_id, request)
 
         def check_election_result():
-            if len(self.votes_received) >= (len(self.node_addresses) // 2) + 1:
-                self.become_leader()
-            else:
-                self.start_election_timer()
+            with self.log_lock:
+                if self.state == CANDIDATE and self.current_term == term and \
+                        len(self.votes_received & set(self.voters())) >= (len(self.voters()) // 2) + 1:
+                    self.become_leader()
+                    return
+            self.start_election_timer()
 
-        timer = threading.Timer(0.1, check_election_result)  # Adjust the duration as needed
-        timer.start()
-    
-    def request_vote_async(self, node_id, last_term):
-        def request_vote_task():
-            with grpc.insecure_channel(self.node_addresses[node_id]) as channel:
-                stub = raft_pb2_grpc.RaftStub(channel)
-                request = raft_pb2.RequestVoteArgs(
-                    term=self.current_term,
-                    candidate_id=self.node_id,
-                    last_log_index=len(self.log),
-                    last_log_term=last_term
-                )
-                try:
-                    response = stub.RequestVote(request, timeout=1)
-                    if response.vote_granted:
-                        self.votes_received.add(node_id)
-                        remaining_lease_duration = self.old_leader_lease_timeout - (time.time() - self.lease_start_time)
-                        if remaining_lease_duration < 0:
-                            remaining_lease_duration = 0
-                        self.old_leader_lease_timeout = max(remaining_lease_duration, response.old_leader_lease_timeout)
-                except grpc.RpcError as e:
-                    self.write_to_dump_file(f"Error occurred while sending RPC to Node {node_id}.")
+        self.start_timer(0.1, check_election_result)  # Adjust the duration as needed
+
+    def request_vote(self, node_id, request):
+        try:
+            response = self.get_stub(node_id).RequestVote(request, timeout=1)
+        except grpc.RpcError as e:
+            self.write_to_dump_file(f"Error occurred while sending RPC to Node {node_id}.", WARNING)
+            return
+        self.handle_vote_reply(node_id, response)
 
-        thread = threading.Thread(target=request_vote_task)
-        thread.start()
-        return thread
+    def handle_vote_reply(self, node_id, response):
+        if response.vote_granted:
+            self.votes_received.add(node_id)
+            remaining_lease_duration = self.old_leader_lease_timeout - (self.now() - self.lease_start_time)
+            if remaining_lease_duration < 0:
+                remaining_lease_duration = 0
+            self.old_leader_lease_timeout = max(remaining_lease_duration, response.old_leader_lease_timeout)
 
     def become_leader(self):
         self.write_to_dump_file(f"Node {self.node_id} became the leader for term {self.current_term}.")
+        self.metrics.inc("raft_elections_won_total")
         self.state = LEADER
         self.current_leader = self.node_id
         self.votes_received = set()
-        self.sent_length = {node_id: len(self.log) for node_id in self.node_addresses}
+        self.sent_length = {node_id: self.last_log_index() for node_id in self.node_addresses}
         self.acked_length = {node_id: 0 for node_id in self.node_addresses}
         # Cancel all existing timers as the node becomes a leader
         self.cancel_election_timer()
@@ -200,48 +504,109 @@ class RaftNode(raft_pb2_grpc.RaftServicer):
         self.cancel_lease_timer()
 
         self.write_to_dump_file("New Leader waiting for Old Leader Lease to timeout.")
-        time.sleep(self.old_leader_lease_timeout)
+        term = self.current_term
+        self.start_timer(self.old_leader_lease_timeout, lambda: self.start_leadership(term))
 
+    def start_leadership(self, term):
+        if self.state != LEADER or self.current_term != term:
+            return
         self.start_lease_timer()
-        self.append_no_op_entry()
+        self.start_replicators()
+        self.append_no_op_entry(term)
         self.send_heartbeats()
 
     def lease_timeout(self):
-        self.write_to_dump_file(f"Leader {self.node_id} lease renewal failed. Stepping Down.")
+        self.write_to_dump_file(f"Leader {self.node_id} lease renewal failed. Stepping Down.", WARNING)
+        self.metrics.inc("raft_lease_renewal_failures_total")
         self.step_down()
 
     def step_down(self):
-        if self.state == LEADER:
+        was_leader = self.state == LEADER
+        if was_leader:
             self.write_to_dump_file(f"{self.node_id} Stepping down")
+            self.metrics.inc("raft_leader_step_downs_total")
         self.state = FOLLOWER
+        if was_leader:
+            self.cancel_commit_waiters()
         self.current_leader = None
         self.votes_received = set()
         self.sent_length = {}
         self.acked_length = {}
+        self.replicate_events = {}
         self.cancel_heartbeat_timer()
         self.cancel_lease_timer()
         self.cancel_election_timer()
         self.start_election_timer()
 
-    def append_no_op_entry(self):
-        self.log.append(raft_pb2.LogEntry(operation="NO-OP", term=self.current_term))
-        self.save_state()
+    def sync_wal(self):
+        start = time.time()
+        self.wal.sync()
+        self.metrics.observe("raft_fsync_seconds", time.time() - start)
+
+    def append_no_op_entry(self, term):
+        with self.log_lock:
+            if self.state != LEADER or self.current_term != term:
+                return
+            self.append_to_log([raft_pb2.LogEntry(operation="NO-OP", term=term)])
+        self.sync_wal()
+        self.trigger_replication()
+
+    def submit_write(self, entry):
+        # Queues a client entry for the next group commit. The returned future resolves
+        # to the log index of the entry, or None if the node is no longer the leader.
+        future = futures.Future()
+        with self.group_commit_cond:
+            self.pending_writes.append((entry, future))
+            self.group_commit_cond.notify()
+        return future
+
+    def group_commit_loop(self):
+        while True:
+            with self.group_commit_cond:
+                while not self.pending_writes:
+                    self.group_commit_cond.wait()
+                deadline = time.time() + GROUP_COMMIT_MAX_DELAY
+                while len(self.pending_writes) < GROUP_COMMIT_MAX_BATCH:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.group_commit_cond.wait(remaining)
+                batch = self.pending_writes[:GROUP_COMMIT_MAX_BATCH]
+                del self.pending_writes[:GROUP_COMMIT_MAX_BATCH]
+            self.flush_group_commit(batch)
+
+    def flush_group_commit(self, batch):
+        term = self.current_term
+        with self.log_lock:
+            # Terms only change under log_lock, so the entries cannot land in the log of a node
+            # that lost its leadership since the batch was queued
+            if self.state != LEADER or self.current_term != term or self.transfer_target is not None:
+                start_index = None
+            else:
+                start_index = self.last_log_index() + 1
+                for entry, future in batch:
+                    entry.term = term
+                self.append_to_log([entry for entry, future in batch])
+        if start_index is None:
+            for entry, future in batch:
+                future.set_result(None)
+            return
+        self.sync_wal()
+        # Ship the whole batch to the followers in one AppendEntries round
+        self.trigger_replication()
+        for i, (entry, future) in enumerate(batch):
+            future.set_result(start_index + i)
 
     def send_heartbeats(self):
-        self.write_to_dump_file(f"Leader {self.node_id} sending heartbeat & Renewing Lease")
+        self.write_to_dump_file(f"Leader {self.node_id} sending heartbeat & Renewing Lease", DEBUG, sampled=True)
 
-        threads = []
-        #self.heartbeat_success_nodes = set()
-        for node_id, node_address in self.node_addresses.items():
-            if node_id != self.node_id:
-                thread = self.replicate_log_async(node_id)
-                threads.append(thread)
+        # Heartbeats only wake the replicators, an idle follower then gets an empty AppendEntries
+        self.trigger_replication()
 
         # Check if the lease should be renewed
-        if len(self.heartbeat_success_count) >= (len(self.node_addresses) // 2):
-            self.write_to_dump_file("Lease renewed successfully.")
-            self.lease_start_time = time.time()
-            self.cancel_lease_timer()
+        if len(self.heartbeat_success_count - self.learners) >= (len(self.voters()) // 2):
+            self.write_to_dump_file("Lease renewed successfully.", DEBUG, sampled=True)
+            self.metrics.inc("raft_lease_renewals_total")
             self.start_lease_timer()
             self.heartbeat_success_count = set()  # Reset the count after renewing the lease
         # else:
@@ -250,84 +615,319 @@ class RaftNode(raft_pb2_grpc.RaftServicer):
         # Ensure heartbeat continues
         self.start_heartbeat_timer()
 
-    def replicate_log_async(self, follower_id):
-        def replicate_log_task():
-            with grpc.insecure_channel(self.node_addresses[follower_id]) as channel:
-                stub = raft_pb2_grpc.RaftStub(channel)
-                prefix_len = self.sent_length.get(follower_id, 0)
-                suffix = self.log[prefix_len:]
-                prefix_term = 0
-                if prefix_len > 0:
-                    prefix_term = self.log[prefix_len - 1].term
-                request = raft_pb2.AppendEntriesArgs(
-                    term=self.current_term,
-                    leader_id=self.node_id,
-                    prev_log_index=prefix_len,
-                    prev_log_term=prefix_term,
-                    entries=suffix,
-                    leader_commit=self.commit_length,
-                    lease_duration=LEASE_DURATION
-                )
-                try:
-                    response = stub.AppendEntries(request, timeout=1)
-                    if response.success:
-                        self.sent_length[follower_id] = prefix_len + len(suffix)
-                        self.acked_length[follower_id] = prefix_len + len(suffix)
-                        self.commit_log_entries()
-                        self.heartbeat_success_count.add(follower_id)
-                    else:
-                        self.sent_length[follower_id] = max(0, self.sent_length.get(follower_id, 0) - 1)
-                        #self.replicate_log_async(follower_id)
-                        self.heartbeat_success_count.add(follower_id)
-                except grpc.RpcError as e:
-                    self.write_to_dump_file(f"Error occurred while sending RPC to Node {follower_id}.")
+    def start_replicators(self):
+        # One long-lived replication thread per follower for the duration of this term
+        term = self.current_term
+        self.replicate_events = {}
+        for node_id in self.node_addresses:
+            if node_id != self.node_id:
+                event = self.create_event()
+                self.replicate_events[node_id] = event
+                self.spawn(self.replicator_loop, node_id, term, event)
+
+    def trigger_replication(self):
+        for event in self.replicate_events.values():
+            event.set()
+
+    def replicator_loop(self, follower_id, term, event):
+        while self.state == LEADER and self.current_term == term:
+            if not event.wait(HEARTBEAT_INTERVAL):
+                continue
+            event.clear()
+            if self.state != LEADER or self.current_term != term:
+                return
+            if self.replicate_log(follower_id) and self.sent_length.get(follower_id, 0) < self.last_log_index():
+                # More entries were appended while the last batch was in flight
+                event.set()
+
+    def replicate_log(self, follower_id):
+        # Only the I/O is done here and in AsyncRaftNode.replicate_log, the window itself is
+        # managed by window_requests, handle_window_reply and window_failed
+        stub = self.get_stub(follower_id)
+        in_flight = collections.deque()
+        while self.state == LEADER:
+            for request in self.window_requests(follower_id, in_flight):
+                in_flight.append((request, stub.AppendEntries.future(request, timeout=1)))
+            if not in_flight:
+                # The entries the follower needs were compacted away
+                return self.send_snapshot(stub, follower_id)
+            request, call = in_flight.popleft()
+            try:
+                response = call.result()
+            except grpc.RpcError as e:
+                return self.window_failed(follower_id, request, in_flight)
+            done = self.handle_window_reply(follower_id, request, response, in_flight)
+            if done is not None:
+                return done
+        return False
+
+    def window_requests(self, follower_id, in_flight):
+        # Yields the batches to send next, the caller adds each one to in_flight. Up to
+        # APPEND_ENTRIES_MAX_IN_FLIGHT batches are sent without waiting for the replies,
+        # sent_length moves ahead as each batch is sent.
+        while len(in_flight) < APPEND_ENTRIES_MAX_IN_FLIGHT and \
+                (not in_flight or self.sent_length.get(follower_id, 0) < self.last_log_index()):
+            request = self.append_entries_request(follower_id)
+            if request is None:
+                return
+            yield request
+            self.sent_length[follower_id] = request.prev_log_index + len(request.entries)
+
+    def handle_window_reply(self, follower_id, request, response, in_flight):
+        # Replies are handled in order, and a rejection drops the rest of the window and resends
+        # from the prefix the follower suggested. Returns True once the follower has the whole
+        # log, False if this node stepped down, and None while there is more to send or wait for.
+        result = self.handle_append_entries_reply(follower_id, request, response)
+        if result is None:
+            self.abandon_in_flight(follower_id, None, in_flight)
+        elif result is False:
+            self.abandon_in_flight(follower_id, request, in_flight)
+            return False
+        elif not in_flight and self.sent_length.get(follower_id, 0) >= self.last_log_index():
+            return True
+        return None
+
+    def window_failed(self, follower_id, request, in_flight):
+        self.write_to_dump_file(f"Error occurred while sending RPC to Node {follower_id}.", WARNING)
+        self.abandon_in_flight(follower_id, request, in_flight)
+        return False
+
+    def abandon_in_flight(self, follower_id, failed_request, in_flight):
+        # Cancels the unanswered requests. If one failed, the next round resends from its prefix.
+        for request, call in in_flight:
+            call.cancel()
+        in_flight.clear()
+        if failed_request is not None:
+            self.sent_length[follower_id] = min(self.sent_length.get(follower_id, 0), failed_request.prev_log_index)
+
+    def append_entries_request(self, follower_id):
+        # Returns None when the follower needs entries that are only left in the snapshot.
+        # A batch holds at most APPEND_ENTRIES_MAX_ENTRIES entries and APPEND_ENTRIES_MAX_BYTES
+        # bytes, but always at least one entry if there is any to send.
+        with self.log_lock:
+            prefix_len = self.sent_length.get(follower_id, 0)
+            if prefix_len < self.log_offset:
+                return None
+            start = prefix_len - self.log_offset
+            end = self.log.batch_end(start, APPEND_ENTRIES_MAX_ENTRIES, APPEND_ENTRIES_MAX_BYTES)
+            request = raft_pb2.AppendEntriesArgs(
+                group_id=self.group_id or 0,
+                term=self.current_term,
+                leader_id=self.node_id,
+                prev_log_index=prefix_len,
+                prev_log_term=self.log_term(prefix_len),
+                leader_commit=self.commit_length,
+                lease_duration=LEASE_DURATION
+            )
+            # The entries are parsed straight from the log buffer, no LogEntry is kept around
+            self.log.read_into(request, start, end)
+        return request
+
+    def handle_append_entries_reply(self, follower_id, request, response):
+        # Returns True if the follower accepted the entries, False if this node stepped down
+        # and None if the request should be retried with the corrected prefix
+        if response.success:
+            # With pipelining sent_length may already be ahead of this batch
+            ack = request.prev_log_index + len(request.entries)
+            self.sent_length[follower_id] = max(self.sent_length.get(follower_id, 0), ack)
+            self.acked_length[follower_id] = max(self.acked_length.get(follower_id, 0), ack)
+            self.commit_log_entries()
+            self.heartbeat_success_count.add(follower_id)
+            return True
+        if self.observe_term(response.term):
+            return False
+        self.heartbeat_success_count.add(follower_id)
+        self.sent_length[follower_id] = self.conflict_prefix_length(request.prev_log_index, response)
+        return None
+
+    def observe_term(self, term):
+        # Steps down if a peer has a newer term. Terms only change under log_lock, so a leader
+        # appending under the lock still leads the term it stamps its entries with.
+        if term <= self.current_term:
+            return False
+        with self.log_lock:
+            if term <= self.current_term:
+                return False
+            self.current_term = term
+            self.voted_for = None
+            self.save_state()
+            self.step_down()
+            return True
+
+    def conflict_prefix_length(self, prefix_len, response):
+        # Skips over the whole conflicting term instead of backing off one entry per round trip
+        with self.log_lock:
+            if response.conflict_term == 0:
+                next_prefix = response.conflict_index - 1
+            else:
+                index = min(prefix_len, self.last_log_index())
+                while index > self.log_offset and self.log_term(index) > response.conflict_term:
+                    index -= 1
+                if index >= self.log_offset and self.log_term(index) == response.conflict_term:
+                    next_prefix = index
+                else:
+                    next_prefix = response.conflict_index - 1
+        return max(0, min(next_prefix, prefix_len - 1))
+
+    def send_snapshot(self, stub, follower_id):
+        requests = self.snapshot_requests()
+        if not requests:
+            return False
+        for request in requests:
+            try:
+                response = stub.InstallSnapshot(request, timeout=5)
+            except grpc.RpcError as e:
+                return self.snapshot_failed(follower_id)
+            if not self.snapshot_chunk_accepted(response):
+                return False
+        self.snapshot_sent(follower_id, requests[-1].last_included_index)
+        return True
+
+    def snapshot_chunk_accepted(self, response):
+        return not self.observe_term(response.term) and response.success
 
-        thread = threading.Thread(target=replicate_log_task)
-        thread.start()
-        return thread
+    def snapshot_failed(self, follower_id):
+        self.write_to_dump_file(f"Error occurred while sending snapshot to Node {follower_id}.", WARNING)
+        return False
+
+    def snapshot_requests(self):
+        # Splits the current snapshot into InstallSnapshot chunks
+        with self.log_lock:
+            last_included_index = self.log_offset
+            last_included_term = self.snapshot_term
+            data = self.snapshot_data
+        if data is None:
+            return []
+        requests = []
+        for offset in range(0, max(len(data), 1), SNAPSHOT_CHUNK_SIZE):
+            requests.append(raft_pb2.InstallSnapshotArgs(
+                group_id=self.group_id or 0,
+                term=self.current_term,
+                leader_id=self.node_id,
+                last_included_index=last_included_index,
+                last_included_term=last_included_term,
+                offset=offset,
+                data=data[offset:offset + SNAPSHOT_CHUNK_SIZE],
+                done=offset + SNAPSHOT_CHUNK_SIZE >= len(data),
+                lease_duration=LEASE_DURATION
+            ))
+        return requests
+
+    def snapshot_sent(self, follower_id, last_included_index):
+        self.write_to_dump_file(f"Leader {self.node_id} sent snapshot up to index {last_included_index} to Node {follower_id}.")
+        self.sent_length[follower_id] = last_included_index
+        self.acked_length[follower_id] = last_included_index
+        self.heartbeat_success_count.add(follower_id)
 
     def commit_log_entries(self):
-        min_acks = (len(self.node_addresses) // 2)
-        ready = [index for index in range(1, len(self.log) + 1)
-                 if len([node_id for node_id, acked_length in self.acked_length.items()
-                         if acked_length >= index]) >= min_acks]
-        if ready and max(ready) > self.commit_length and self.log[max(ready) - 1].term == self.current_term:
-            for i in range(self.commit_length, max(ready)):
-                entry = self.log[i]
+        # With the match indices of the N voters sorted in descending order (the leader matches its
+        # whole log), the one at position N // 2 is stored on a majority of them. Learners do not count.
+        voters = self.voters()
+        match_indices = sorted((self.last_log_index() if node_id == self.node_id else self.acked_length.get(node_id, 0)
+                                for node_id in voters), reverse=True)
+        quorum_index = match_indices[len(voters) // 2]
+        with self.log_lock:
+            ready = quorum_index > self.commit_length and self.log_term(quorum_index) == self.current_term
+        if ready:
+            self.apply_log_entries(quorum_index, "leader")
+
+    def apply_log_entries(self, commit_length, role):
+        with self.log_lock:
+            if commit_length <= self.commit_length:
+                return
+            for i in range(self.commit_length + 1, commit_length + 1):
+                entry = self.log_entry(i)
+                self.apply_entry(entry)
+                if self.watchers:
+                    self.publish_watch_events(i, entry)
                 if entry.operation == "SET":
-                    self.data_store[entry.key] = entry.value
-                    self.write_to_dump_file(f"Node {self.node_id} (leader) committed the entry {entry.operation} {entry.key} {entry.value} to the state machine.")
-            self.commit_length = max(ready)
+                    self.write_to_dump_file(f"Node {self.node_id} ({role}) committed the entry {entry.operation} {entry.key} {entry.value} to the state machine.", DEBUG, sampled=True)
+                elif entry.operation == "BATCH":
+                    self.write_to_dump_file(f"Node {self.node_id} ({role}) committed a BATCH of {len(entry.pairs)} keys to the state machine.", DEBUG, sampled=True)
+            self.commit_length = commit_length
+            for watcher in self.watchers:
+                if not watcher.overflowed:
+                    watcher.commit_index = max(watcher.commit_index, commit_length)
+                    if watcher.events:
+                        watcher.changed.set()
             self.save_state()
+            if self.snapshot_due():
+                self.take_snapshot()
+        self.notify_commit_waiters()
+
+    def apply_entry(self, entry):
+        # Called with log_lock held, readers take it too so they never see half of a BATCH
+        for pair in entry_pairs(entry):
+            self.data_store[pair.key] = pair.value
+
+    def wait_for_commit(self, index, leader_only=False):
+        # The returned future resolves to True once index is committed, or to False if
+        # leader_only is set and this node steps down before that happens
+        future = futures.Future()
+        with self.commit_waiters_lock:
+            if self.commit_length >= index:
+                future.set_result(True)
+            elif leader_only and self.state != LEADER:
+                future.set_result(False)
+            else:
+                heapq.heappush(self.commit_waiters, (index, next(self.commit_waiter_ids), future, leader_only))
+        return future
+
+    def notify_commit_waiters(self):
+        # The futures are resolved after commit_waiters_lock is released: their callbacks take
+        # log_lock, which the follower path already holds when it gets here
+        ready = []
+        with self.commit_waiters_lock:
+            while self.commit_waiters and self.commit_waiters[0][0] <= self.commit_length:
+                ready.append(heapq.heappop(self.commit_waiters)[2])
+        for future in ready:
+            future.set_result(True)
+
+    def cancel_commit_waiters(self):
+        cancelled = []
+        with self.commit_waiters_lock:
+            remaining = []
+            for waiter in self.commit_waiters:
+                if waiter[3]:
+                    cancelled.append(waiter[2])
+                else:
+                    remaining.append(waiter)
+            heapq.heapify(remaining)
+            self.commit_waiters = remaining
+        for future in cancelled:
+            future.set_result(False)
 
     def RequestVote(self, request, context):
-        if request.term > self.current_term:
-            self.current_term = request.term
-            self.voted_for = None
-            self.save_state()
-            self.step_down()
+        self.observe_term(request.term)
 
-        if request.term == self.current_term:
-            if self.voted_for is None or self.voted_for == request.candidate_id:
-                last_term = 0
-                if self.log:
-                    last_term = self.log[-1].term
-                log_ok = (request.last_log_term > last_term) or \
-                         (request.last_log_term == last_term and request.last_log_index >= len(self.log))
-                if log_ok:
-                    self.voted_for = request.candidate_id
-                    self.save_state()
-                    self.write_to_dump_file(f"Vote granted for Node {request.candidate_id} in term {request.term}.")
-
-                    remaining_lease_duration = self.old_leader_lease_timeout - (time.time() - self.lease_start_time)
-                    if remaining_lease_duration < 0:
-                        remaining_lease_duration = 0
+        # The vote is decided under log_lock, so two candidates of one term never both get it
+        with self.log_lock:
+            if request.term == self.current_term:
+                if self.voted_for is None or self.voted_for == request.candidate_id:
+                    last_term = self.log_term(self.last_log_index())
+                    log_ok = (request.last_log_term > last_term) or \
+                             (request.last_log_term == last_term and request.last_log_index >= self.last_log_index())
+                    if log_ok:
+                        self.voted_for = request.candidate_id
+                        self.save_state()
+                        self.write_to_dump_file(f"Vote granted for Node {request.candidate_id} in term {request.term}.")
 
-                    return raft_pb2.RequestVoteReply(
-                        term=self.current_term,
-                        vote_granted=True,
-                        old_leader_lease_timeout=remaining_lease_duration
-                    )
+                        remaining_lease_duration = self.old_leader_lease_timeout - (self.now() - self.lease_start_time)
+                        if remaining_lease_duration < 0 or request.leadership_transfer:
+                            remaining_lease_duration = 0
+
+                        return raft_pb2.RequestVoteReply(
+                            term=self.current_term,
+                            vote_granted=True,
+                            old_leader_lease_timeout=remaining_lease_duration
+                        )
+                    else:
+                        self.write_to_dump_file(f"Vote denied for Node {request.candidate_id} in term {request.term}.")
+                        return raft_pb2.RequestVoteReply(
+                            term=self.current_term,
+                            vote_granted=False,
+                            old_leader_lease_timeout=self.old_leader_lease_timeout
+                        )
                 else:
                     self.write_to_dump_file(f"Vote denied for Node {request.candidate_id} in term {request.term}.")
                     return raft_pb2.RequestVoteReply(
@@ -342,96 +942,679 @@ class RaftNode(raft_pb2_grpc.RaftServicer):
                     vote_granted=False,
                     old_leader_lease_timeout=self.old_leader_lease_timeout
                 )
-        else:
-            self.write_to_dump_file(f"Vote denied for Node {request.candidate_id} in term {request.term}.")
-            return raft_pb2.RequestVoteReply(
-                term=self.current_term,
-                vote_granted=False,
-                old_leader_lease_timeout=self.old_leader_lease_timeout
-            )
 
     def AppendEntries(self, request, context):
-        if request.term > self.current_term:
-            self.current_term = request.term
-            self.voted_for = None
-            self.save_state()
-            self.step_down()
+        self.observe_term(request.term)
 
         if request.term == self.current_term:
             self.state = FOLLOWER
             self.current_leader = request.leader_id
             self.cancel_election_timer()
             self.old_leader_lease_timeout = request.lease_duration
-            self.lease_start_time = time.time()
+            self.lease_start_time = self.now()
             self.start_election_timer()
 
-        log_ok = (len(self.log) >= request.prev_log_index) and \
-                (request.prev_log_index == 0 or self.log[request.prev_log_index - 1].term == request.prev_log_term)
+        with self.log_lock:
+            if request.term == self.current_term and request.prev_log_index > self.last_log_index():
+                self.wait_for_log(request.prev_log_index)
+            log_ok = (self.last_log_index() >= request.prev_log_index) and \
+                    (request.prev_log_index <= self.log_offset or self.log_term(request.prev_log_index) == request.prev_log_term)
         if request.term == self.current_term and log_ok:
             self.append_entries(request.prev_log_index, request.leader_commit, request.entries)
+            if self.commit_length >= request.leader_commit:
+                # Only a follower that has applied everything the leader had committed is up to date
+                self.last_leader_contact = self.lease_start_time
             ack = request.prev_log_index + len(request.entries)
-            self.write_to_dump_file(f"Node {self.node_id} accepted AppendEntries RPC from {request.leader_id}.")
+            self.write_to_dump_file(f"Node {self.node_id} accepted AppendEntries RPC from {request.leader_id}.", DEBUG, sampled=True)
             return raft_pb2.AppendEntriesReply(term=self.current_term, success=True, ack=ack)
         else:
-            self.write_to_dump_file(f"Node {self.node_id} rejected AppendEntries RPC from {request.leader_id}.")
-            return raft_pb2.AppendEntriesReply(term=self.current_term, success=False, ack=0)
+            self.write_to_dump_file(f"Node {self.node_id} rejected AppendEntries RPC from {request.leader_id}.", DEBUG)
+            conflict_term, conflict_index = self.conflict_hint(request.prev_log_index)
+            return raft_pb2.AppendEntriesReply(term=self.current_term, success=False, ack=0,
+                                               conflict_term=conflict_term, conflict_index=conflict_index)
+
+    def conflict_hint(self, prev_log_index):
+        # Tells the leader where our log stops matching: either how long it is, or the
+        # first index of the term found at prev_log_index
+        with self.log_lock:
+            if self.last_log_index() < prev_log_index:
+                return 0, self.last_log_index() + 1
+            if prev_log_index <= self.log_offset:
+                return 0, self.log_offset + 1
+            conflict_term = self.log_term(prev_log_index)
+            index = prev_log_index
+            while index > self.log_offset + 1 and self.log_term(index - 1) == conflict_term:
+                index -= 1
+            return conflict_term, index
 
     def append_entries(self, prev_log_index, leader_commit, entries):
-        if entries and len(self.log) > prev_log_index:
-            index = min(len(self.log), prev_log_index + len(entries)) - 1
-            if self.log[index].term != entries[index - prev_log_index].term:
-                self.log = self.log[:prev_log_index]
-        if prev_log_index + len(entries) > len(self.log):
-            self.log.extend(entries[len(self.log) - prev_log_index:])
-        if leader_commit > self.commit_length:
-            for i in range(self.commit_length, leader_commit):
-                entry = self.log[i]
-                if entry.operation == "SET":
-                    self.data_store[entry.key] = entry.value
-                    self.write_to_dump_file(f"Node {self.node_id} (follower) committed the entry {entry.operation} {entry.key} {entry.value} to the state machine.")
-            self.commit_length = leader_commit
-        self.save_state()
+        with self.log_lock:
+            if prev_log_index < self.log_offset:
+                # Entries up to log_offset are already part of our snapshot
+                entries = entries[self.log_offset - prev_log_index:]
+                prev_log_index = self.log_offset
+            if entries and self.last_log_index() > prev_log_index:
+                index = min(self.last_log_index(), prev_log_index + len(entries))
+                if self.log_term(index) != entries[index - prev_log_index - 1].term:
+                    self.truncate_log(prev_log_index)
+            if prev_log_index + len(entries) > self.last_log_index():
+                self.append_to_log(entries[self.last_log_index() - prev_log_index:])
+                self.sync_wal()
+            leader_commit = min(leader_commit, prev_log_index + len(entries))
+            if leader_commit > self.commit_length:
+                self.apply_log_entries(leader_commit, "follower")
 
-    def ServeClient(self, request, context):
+    def InstallSnapshot(self, request, context):
+        self.observe_term(request.term)
+
+        if request.term < self.current_term:
+            return raft_pb2.InstallSnapshotReply(term=self.current_term, success=False)
+
+        self.state = FOLLOWER
+        self.current_leader = request.leader_id
+        self.cancel_election_timer()
+        self.old_leader_lease_timeout = request.lease_duration
+        self.lease_start_time = self.now()
+        self.start_election_timer()
+
+        if request.offset == 0:
+            self.snapshot_buffer = bytearray()
+        if request.offset != len(self.snapshot_buffer):
+            return raft_pb2.InstallSnapshotReply(term=self.current_term, success=False)
+        self.snapshot_buffer.extend(request.data)
+        if request.done:
+            data = bytes(self.snapshot_buffer)
+            self.snapshot_buffer = bytearray()
+            self.install_snapshot(raft_pb2.Snapshot.FromString(data), data)
+        return raft_pb2.InstallSnapshotReply(term=self.current_term, success=True)
+
+    def leader_can_read(self):
+        # The lease guarantees no other leader exists, and an entry from our own term must be
+        # committed for commit_length to cover everything earlier leaders committed
+        return self.state == LEADER and self.lease_timer is not None and \
+            self.log_term(self.commit_length) == self.current_term
+
+    def ReadIndex(self, request, context):
+        if self.leader_can_read():
+            return raft_pb2.ReadIndexReply(term=self.current_term, success=True, read_index=self.commit_length)
+        return raft_pb2.ReadIndexReply(term=self.current_term, success=False)
+
+    def request_read_index(self):
+        leader_id = self.current_leader
+        if leader_id is None or leader_id == self.node_id:
+            return None
+        try:
+            response = self.get_stub(leader_id).ReadIndex(raft_pb2.ReadIndexArgs(node_id=self.node_id, group_id=self.group_id or 0), timeout=1)
+        except grpc.RpcError as e:
+            self.write_to_dump_file(f"Error occurred while sending ReadIndex RPC to Node {leader_id}.", WARNING)
+            return None
+        if not response.success:
+            return None
+        return response.read_index
+
+    def can_serve_read(self, consistency, max_staleness):
         if self.state == LEADER:
-            parts = request.Request.split()
-            if parts[0] == "GET":
-                key = parts[1]
-                value = self.data_store.get(key, "")
-                return raft_pb2.ServeClientReply(Data=value, LeaderID=str(self.node_id), Success=True)
-            
-            elif parts[0] == "SET":
-                key = parts[1]
-                value = parts[2]
-                log_entry = raft_pb2.LogEntry(operation="SET", key=key, value=value, term=self.current_term)
-                self.log.append(log_entry)
-                self.save_state()
-
-                # Wait for the entry to be committed
-                while self.commit_length < len(self.log):
-                    time.sleep(0.1)  # Adjust the sleep duration as needed
-
-                # Check if the committed entry matches the appended entry
-                if self.log[self.commit_length - 1] == log_entry:
-                    return raft_pb2.ServeClientReply(Data=f"{key} set to {value} successfully!", LeaderID=str(self.node_id), Success=True)
-                else:
-                    return raft_pb2.ServeClientReply(Data="", LeaderID=str(self.node_id), Success=False)
+            return self.leader_can_read()
+        if consistency == raft_pb2.READ_INDEX:
+            read_index = self.request_read_index()
+            try:
+                return read_index is not None and self.wait_for_commit(read_index).result(timeout=READ_INDEX_TIMEOUT)
+            except futures.TimeoutError:
+                return False
+        if consistency == raft_pb2.BOUNDED_STALENESS:
+            max_staleness = max_staleness or DEFAULT_MAX_STALENESS
+            return self.current_leader is not None and self.now() - self.last_leader_contact <= max_staleness
+        return False
+
+    def read_leader_id(self):
+        return str(self.node_id if self.state == LEADER else self.current_leader)
+
+    def submit_set(self, key, value):
+        return self.submit_client_write(raft_pb2.LogEntry(operation="SET", key=key, value=value),
+                                        f"{key} set to {value} successfully!")
+
+    def submit_batch(self, pairs):
+        # All pairs go into a single log entry, so they are committed and applied together
+        return self.submit_client_write(raft_pb2.LogEntry(operation="BATCH", pairs=pairs),
+                                        f"{len(pairs)} keys set successfully!")
+
+    def submit_client_write(self, log_entry, data):
+        # Returns a future resolving to the ServeClientReply once the entry is committed
+        reply = futures.Future()
+        start = self.now()
+
+        def on_committed(index, committed):
+            # Check if the committed entry matches the appended entry
+            with self.log_lock:
+                matches = committed.result() and (index <= self.log_offset or self.log_entry(index) == log_entry)
+            if matches:
+                self.metrics.observe("raft_commit_latency_seconds", self.now() - start)
+                reply.set_result(raft_pb2.ServeClientReply(Data=data, LeaderID=str(self.node_id), Success=True))
+            else:
+                reply.set_result(raft_pb2.ServeClientReply(Data="", LeaderID=str(self.current_leader), Success=False))
+
+        def on_appended(appended):
+            index = appended.result()
+            if index is None:
+                reply.set_result(raft_pb2.ServeClientReply(Data="", LeaderID=str(self.current_leader), Success=False))
+                return
+            # Wait for the entry to be committed
+            self.wait_for_commit(index, leader_only=True).add_done_callback(lambda committed: on_committed(index, committed))
+
+        self.submit_write(log_entry).add_done_callback(on_appended)
+        return reply
+
+    def submit_client_request(self, request):
+        # Returns a future resolving to the ServeClientReply of a single GET or SET command
+        parts = request.Request.split()
+        if parts[0] == "SET" and self.state == LEADER:
+            return self.submit_set(parts[1], parts[2])
+        reply = futures.Future()
+        if parts[0] == "GET" and self.can_serve_read(request.Consistency, request.MaxStaleness):
+            value = self.read_value(parts[1])
+            reply.set_result(raft_pb2.ServeClientReply(Data=value, LeaderID=self.read_leader_id(), Success=True))
         else:
-            return raft_pb2.ServeClientReply(Data="", LeaderID=str(self.current_leader), Success=False)
+            reply.set_result(raft_pb2.ServeClientReply(Data="", LeaderID=str(self.current_leader), Success=False))
+        return reply
+
+    def ServeClient(self, request, context):
+        return self.submit_client_request(request).result()
+
+    def MultiGet(self, request, context):
+        if not self.can_serve_read(request.Consistency, request.MaxStaleness):
+            return raft_pb2.MultiGetReply(LeaderID=str(self.current_leader), Success=False)
+        return raft_pb2.MultiGetReply(Values=self.read_values(request.Keys), LeaderID=self.read_leader_id(), Success=True)
+
+    def read_value(self, key):
+        with self.log_lock:
+            return self.data_store.get(key, "")
+
+    def read_values(self, keys):
+        # Read at a single point in the log, like a scan
+        with self.log_lock:
+            return [self.data_store.get(key, "") for key in keys]
+
+    def scan_replies(self, request):
+        # The whole range is read under log_lock so the scan sees a single point in the log,
+        # and then streamed back in chunks of SCAN_CHUNK_SIZE pairs
+        with self.log_lock:
+            pairs = self.data_store.scan(request.Start, request.End, request.Limit)
+        leader_id = self.read_leader_id()
+        for offset in range(0, max(len(pairs), 1), SCAN_CHUNK_SIZE):
+            chunk = [raft_pb2.KeyValue(key=key, value=value) for key, value in pairs[offset:offset + SCAN_CHUNK_SIZE]]
+            yield raft_pb2.ScanReply(Pairs=chunk, LeaderID=leader_id, Success=True)
+
+    def Scan(self, request, context):
+        # Like GET, the leader serves the scan under its lease and followers depending on Consistency
+        if not self.can_serve_read(request.Consistency, request.MaxStaleness):
+            yield raft_pb2.ScanReply(LeaderID=str(self.current_leader), Success=False)
+            return
+        yield from self.scan_replies(request)
+
+    def start_watch(self, request):
+        # Registers a Watcher after collecting the changes from FromIndex to the commit index, both
+        # under log_lock so no change is missed or sent twice. Returns the watcher, or None if those
+        # entries were compacted, and the first replies.
+        watcher = Watcher(request.Prefix, self.create_event())
+        with self.log_lock:
+            from_index = self.commit_length if request.FromNow else request.FromIndex
+            if from_index < self.log_offset:
+                return None, [raft_pb2.WatchReply(CommitIndex=self.commit_length, Compacted=True)]
+            for index, entry in enumerate(self.log.entries(from_index - self.log_offset, self.commit_length - self.log_offset),
+                                          from_index + 1):
+                watcher.add(index, entry_pairs(entry))
+            # A follower behind FromIndex must not send the changes up to it again once it applies them
+            watcher.commit_index = max(from_index, self.commit_length)
+            self.watchers.add(watcher)
+            return watcher, watcher.take_replies()
+
+    def watch_replies(self, watcher):
+        # An empty list ends the stream of a watcher that fell too far behind, the client resumes
+        # it from the last CommitIndex it received
+        with self.log_lock:
+            if watcher.overflowed:
+                return []
+            replies = watcher.take_replies()
+            if watcher.compacted:
+                replies.append(raft_pb2.WatchReply(CommitIndex=watcher.commit_index, Compacted=True))
+            return replies
+
+    def stop_watch(self, watcher):
+        with self.log_lock:
+            self.watchers.discard(watcher)
+
+    def publish_watch_events(self, index, entry):
+        pairs = entry_pairs(entry)
+        for watcher in self.watchers:
+            if not watcher.overflowed and index > watcher.commit_index:
+                watcher.add(index, pairs)
+                if len(watcher.events) > WATCH_MAX_PENDING_EVENTS:
+                    watcher.overflowed = True
+                    watcher.events = []
+                    watcher.changed.set()
+
+    def Watch(self, request, context):
+        # Every node applies the same committed entries, so any node serves watches. Changes are
+        # sent as they are applied, and an idle stream gets a reply without events every
+        # WATCH_PROGRESS_INTERVAL seconds so the client knows the index to resume from.
+        watcher, replies = self.start_watch(request)
+        if watcher is not None:
+            context.add_callback(watcher.changed.set)  # A cancelled stream gives its thread back right away
+        try:
+            yield from replies
+            while watcher is not None and context.is_active():
+                watcher.changed.wait(WATCH_PROGRESS_INTERVAL)
+                replies = self.watch_replies(watcher)
+                yield from replies
+                if not replies or watcher.compacted:
+                    return
+        finally:
+            if watcher is not None:
+                self.stop_watch(watcher)
+
+    def MultiSet(self, request, context):
+        if self.state != LEADER:
+            return raft_pb2.MultiSetReply(LeaderID=str(self.current_leader), Success=False)
+        if request.Atomic:
+            reply = self.submit_batch(request.Pairs).result()
+            return raft_pb2.MultiSetReply(Results=[reply.Success] * len(request.Pairs), LeaderID=reply.LeaderID,
+                                          Success=reply.Success)
+        # All SETs are queued before waiting so they share group commits
+        replies = [self.submit_set(pair.key, pair.value) for pair in request.Pairs]
+        results = [reply.result().Success for reply in replies]
+        return raft_pb2.MultiSetReply(Results=results, LeaderID=str(self.node_id), Success=all(results))
+
+    def ServeClientStream(self, request_iterator, context):
+        return serve_client_stream(self.submit_client_request, request_iterator, context)
+
+    def collect_metrics(self):
+        labels = {} if self.group_id is None else {"group": self.group_id}
+        with self.log_lock:
+            last_log_index = self.last_log_index()
+            samples = [
+                metric("raft_term", self.current_term, labels),
+                metric("raft_state", self.state, labels),
+                metric("raft_commit_index", self.commit_length, labels),
+                metric("raft_last_log_index", last_log_index, labels),
+                metric("raft_snapshot_index", self.log_offset, labels),
+                metric("raft_log_entries", len(self.log), labels),
+                metric("raft_log_bytes", self.log.memory_size(), labels),
+                metric("raft_recovery_seconds", self.recovery_seconds, labels),
+                metric("raft_wal_bytes", self.wal.size(), labels),
+                metric("raft_pending_writes", len(self.pending_writes), labels),
+                metric("raft_commit_waiters", len(self.commit_waiters), labels),
+                metric("raft_voters", len(self.voters()), labels),
+            ]
+        if self.state == LEADER:
+            # Replication progress of every follower, lag is counted in log entries
+            for follower_id, acked in list(self.acked_length.items()):
+                if follower_id == self.node_id:
+                    continue
+                follower_labels = dict(labels, follower=follower_id)
+                samples.append(metric("raft_follower_sent_index", self.sent_length.get(follower_id, 0), follower_labels))
+                samples.append(metric("raft_follower_acked_index", acked, follower_labels))
+                samples.append(metric("raft_follower_lag_entries", last_log_index - acked, follower_labels))
+        return samples + self.metrics.samples(**labels)
+
+    def GetMetrics(self, request, context):
+        return raft_pb2.GetMetricsReply(metrics=self.collect_metrics())
+
+    def promotion_check(self, node_id):
+        # Returns a PromoteLearnerReply if the promotion cannot be started now, otherwise None
+        if self.state != LEADER:
+            return raft_pb2.PromoteLearnerReply(Success=False, LeaderID=str(self.current_leader))
+        if node_id not in self.learners:
+            return raft_pb2.PromoteLearnerReply(Success=node_id in self.node_addresses, LeaderID=str(self.node_id))
+        with self.log_lock:
+            # Only one membership change may be in progress at a time
+            pending = any(index > self.commit_length for index, node_id in self.log_promotions) or \
+                      any(entry.operation == "PROMOTE" for entry, future in self.pending_writes)
+            lag = self.last_log_index() - self.acked_length.get(node_id, 0)
+        if pending or lag > PROMOTE_MAX_LAG:
+            return raft_pb2.PromoteLearnerReply(Success=False, LeaderID=str(self.node_id))
+        return None
+
+    def PromoteLearner(self, request, context):
+        with self.membership_lock:
+            reply = self.promotion_check(request.node_id)
+            if reply is not None:
+                return reply
+            appended = self.submit_write(raft_pb2.LogEntry(operation="PROMOTE", key=str(request.node_id)))
+            index = appended.result()
+        committed = index is not None and self.wait_for_commit(index, leader_only=True).result()
+        if committed:
+            self.write_to_dump_file(f"Leader {self.node_id} promoted learner Node {request.node_id} to voter.")
+        return raft_pb2.PromoteLearnerReply(Success=committed, LeaderID=str(self.current_leader))
+
+    def choose_transfer_target(self):
+        # The voter whose log is the most up to date
+        candidates = [node_id for node_id in self.voters() if node_id != self.node_id]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda node_id: self.acked_length.get(node_id, 0))
+
+    def start_transfer(self, target_id):
+        # Returns the node leadership will be transferred to, or None if it cannot be transferred.
+        # New writes are refused until the transfer is over.
+        if self.state != LEADER:
+            return None
+        if target_id is None:
+            target_id = self.choose_transfer_target()
+        if target_id is None or target_id == self.node_id or target_id not in self.voters():
+            return None
+        self.transfer_target = target_id
+        self.trigger_replication()
+        return target_id
+
+    def target_caught_up(self, target_id):
+        return self.acked_length.get(target_id, 0) >= self.last_log_index()
+
+    def transfer_progress(self, target_id, term, deadline):
+        # Returns the TimeoutNow request to send once the target has our whole log, None while it
+        # is still catching up and False if the transfer has to be given up
+        if self.state != LEADER or self.current_term != term or self.now() > deadline:
+            return False
+        if not self.target_caught_up(target_id):
+            return None
+        return self.hand_off_leadership(target_id)
+
+    def transfer_settled(self, target_id, deadline):
+        # Once the target was told to campaign, it either wins the election or the transfer times out
+        return self.current_leader == target_id or self.now() >= deadline
+
+    def timeout_now_failed(self, target_id):
+        self.write_to_dump_file(f"Error occurred while sending TimeoutNow RPC to Node {target_id}.", WARNING)
+        return False
+
+    def hand_off_leadership(self, target_id):
+        # Steps down, giving up the lease, before the target is told to campaign so it
+        # does not have to wait the lease out. Returns the TimeoutNow request to send.
+        self.write_to_dump_file(f"Leader {self.node_id} transferring leadership to Node {target_id}.")
+        request = raft_pb2.TimeoutNowArgs(group_id=self.group_id or 0, term=self.current_term, leader_id=self.node_id)
+        self.step_down()
+        return request
+
+    def transfer_leadership(self, target_id=None):
+        # Returns True once target_id (by default the most up-to-date voter) has become leader
+        target_id = self.start_transfer(target_id)
+        if target_id is None:
+            return False
+        term = self.current_term
+        deadline = self.now() + TRANSFER_TIMEOUT
+        try:
+            request = self.transfer_progress(target_id, term, deadline)
+            while request is None:
+                time.sleep(TRANSFER_POLL_INTERVAL)
+                request = self.transfer_progress(target_id, term, deadline)
+            if request is False:
+                return False
+            try:
+                self.get_stub(target_id).TimeoutNow(request, timeout=1)
+            except grpc.RpcError as e:
+                return self.timeout_now_failed(target_id)
+            while not self.transfer_settled(target_id, deadline):
+                time.sleep(TRANSFER_POLL_INTERVAL)
+            return self.transfer_finished(target_id)
+        finally:
+            self.transfer_target = None
+
+    def transfer_finished(self, target_id):
+        if self.current_leader != target_id:
+            return False
+        self.metrics.inc("raft_leadership_transfers_total")
+        return True
+
+    def TransferLeadership(self, request, context):
+        target_id = int(request.TargetID) if request.TargetID else None
+        if self.state == LEADER and target_id == self.node_id:
+            return raft_pb2.TransferLeadershipReply(Success=True, LeaderID=str(self.node_id))
+        if self.state != LEADER:
+            done = target_id is not None and target_id == self.current_leader
+            return raft_pb2.TransferLeadershipReply(Success=done, LeaderID=str(self.current_leader))
+        success = self.transfer_leadership(target_id)
+        return raft_pb2.TransferLeadershipReply(Success=success, LeaderID=str(self.current_leader))
+
+    def TimeoutNow(self, request, context):
+        # Sent by our leader once we have its whole log, we start an election right away
+        if request.term != self.current_term or self.is_learner():
+            return raft_pb2.TimeoutNowReply(term=self.current_term, success=False)
+        self.cancel_election_timer()
+        self.start_election(leadership_transfer=True)
+        return raft_pb2.TimeoutNowReply(term=self.current_term, success=True)
+
+    def shutdown(self, transfer=True):
+        if transfer and self.state == LEADER:
+            # Hand leadership over so a planned restart does not leave the cluster leaderless
+            self.transfer_leadership()
+        self.save_state()
+        self.wal.close()
+        self.cancel_election_timer()
+        self.cancel_heartbeat_timer()
+        self.cancel_lease_timer()
+        self.close_channels()
+        self.dump_logger.close()
+
+def serve_client_stream(submit_client_request, request_iterator, context):
+    # Requests are read and SETs submitted on a separate thread so many writes are in flight
+    # at once. Replies are streamed back in request order, and GETs are only evaluated once
+    # every earlier operation on the stream has completed so they observe its writes. A GET is
+    # also a barrier: later SETs are only submitted once it has been evaluated.
+    pending = queue.Queue(maxsize=STREAM_MAX_IN_FLIGHT)
+
+    def put(item):
+        while context.is_active():
+            try:
+                pending.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def wait(event):
+        while context.is_active():
+            if event.wait(timeout=1):
+                return True
+        return False
+
+    def submit_requests():
+        try:
+            for request in request_iterator:
+                if request.Request.startswith("SET"):
+                    if not put(submit_client_request(request)):
+                        return
+                    continue
+                evaluated = threading.Event()
+                if not put((request, evaluated)) or not wait(evaluated):
+                    return
+        except grpc.RpcError:
+            pass
+        put(None)
+
+    threading.Thread(target=submit_requests, daemon=True).start()
+    while True:
+        try:
+            item = pending.get(timeout=1)
+        except queue.Empty:
+            if context.is_active():
+                continue
+            return  # Cancelled, submit_requests gave up without queueing the end of the stream
+        if item is None:
+            return
+        if isinstance(item, tuple):
+            request, evaluated = item
+            item = submit_client_request(request)
+            evaluated.set()
+        yield item.result()
+
+class Watcher:
+    # A Watch stream. The node adds the changes of matching keys while it applies committed
+    # entries and sets changed, and the stream sends them on. Guarded by the node's log_lock.
+    def __init__(self, prefix, changed):
+        self.prefix = prefix
+        self.changed = changed
+        self.events = []
+        self.commit_index = 0  # The changes up to this index are in events or were sent
+        self.overflowed = False
+        self.compacted = False
+
+    def add(self, index, pairs):
+        for pair in pairs:
+            if pair.key.startswith(self.prefix):
+                self.events.append(raft_pb2.WatchEvent(Index=index, Key=pair.key, Value=pair.value))
+
+    def take_replies(self):
+        # Splits the pending events into replies of at most WATCH_CHUNK_SIZE events. A reply only
+        # claims the indices that it completes, so a resumed watch never skips an event.
+        events, self.events = self.events, []
+        self.changed.clear()
+        replies = []
+        for offset in range(0, max(len(events), 1), WATCH_CHUNK_SIZE):
+            rest = events[offset + WATCH_CHUNK_SIZE:offset + WATCH_CHUNK_SIZE + 1]
+            commit_index = rest[0].Index - 1 if rest else self.commit_index
+            replies.append(raft_pb2.WatchReply(Events=events[offset:offset + WATCH_CHUNK_SIZE], CommitIndex=commit_index))
+        return replies
+
+def entry_pairs(entry):
+    # The key-value pairs a log entry writes
+    if entry.operation == "SET":
+        return [entry]
+    return entry.pairs
+
+def request_key(request):
+    parts = request.Request.split()
+    return parts[1] if len(parts) > 1 else ""
+
+class MultiRaftServer(raft_pb2_grpc.RaftServicer):
+    # Hosts one replica of every Raft group in a single process. The keyspace is partitioned
+    # by key hash, peer RPCs are dispatched on their group_id and client requests are routed
+    # to the group owning the key.
+    def __init__(self, node_id, node_addresses, num_groups, learner_ids=()):
+        self.node_id = node_id
+        self.groups = [RaftNode(node_id, node_addresses, group_id, learner_ids) for group_id in range(num_groups)]
+        # All groups talk to the same peers, so they share one channel pool
+        for group in self.groups[1:]:
+            group.channels = self.groups[0].channels
+            group.stubs = self.groups[0].stubs
+            group.channel_lock = self.groups[0].channel_lock
+
+    def group_for_key(self, key):
+        return self.groups[zlib.crc32(key.encode()) % len(self.groups)]
+
+    def start_election_timer(self):
+        for group in self.groups:
+            group.start_election_timer()
+
+    def shutdown(self):
+        # Every group hands off its leadership before any of them closes the shared channels
+        transfers = [threading.Thread(target=group.transfer_leadership) for group in self.groups if group.state == LEADER]
+        for thread in transfers:
+            thread.start()
+        for thread in transfers:
+            thread.join()
+        for group in self.groups:
+            group.shutdown(transfer=False)
+
+    def TransferLeadership(self, request, context):
+        return self.groups[request.group_id].TransferLeadership(request, context)
+
+    def TimeoutNow(self, request, context):
+        return self.groups[request.group_id].TimeoutNow(request, context)
+
+    def Watch(self, request, context):
+        return self.groups[request.group_id].Watch(request, context)
+
+    def GetMetrics(self, request, context):
+        return raft_pb2.GetMetricsReply(metrics=[sample for group in self.groups for sample in group.collect_metrics()])
+
+    def RequestVote(self, request, context):
+        return self.groups[request.group_id].RequestVote(request, context)
+
+    def AppendEntries(self, request, context):
+        return self.groups[request.group_id].AppendEntries(request, context)
+
+    def InstallSnapshot(self, request, context):
+        return self.groups[request.group_id].InstallSnapshot(request, context)
+
+    def ReadIndex(self, request, context):
+        return self.groups[request.group_id].ReadIndex(request, context)
+
+    def PromoteLearner(self, request, context):
+        return self.groups[request.group_id].PromoteLearner(request, context)
+
+    def Scan(self, request, context):
+        # Keys are partitioned by hash, so a scan covers one group and clients merge the groups
+        return self.groups[request.group_id].Scan(request, context)
+
+    def submit_client_request(self, request):
+        return self.group_for_key(request_key(request)).submit_client_request(request)
+
+    def ServeClient(self, request, context):
+        return self.submit_client_request(request).result()
+
+    def MultiGet(self, request, context):
+        # Every key must belong to a group this node can serve the read for
+        keys_by_group = {}
+        for key in request.Keys:
+            keys_by_group.setdefault(self.group_for_key(key), []).append(key)
+        values = {}
+        leader_id = str(self.node_id)
+        for group, keys in keys_by_group.items():
+            reply = group.MultiGet(raft_pb2.MultiGetArgs(Keys=keys, Consistency=request.Consistency,
+                                                         MaxStaleness=request.MaxStaleness), context)
+            if not reply.Success:
+                return reply
+            values.update(zip(keys, reply.Values))
+            if keys[0] == request.Keys[0]:
+                leader_id = reply.LeaderID  # The client routes a MultiGet by its first key
+        return raft_pb2.MultiGetReply(Values=[values[key] for key in request.Keys], LeaderID=leader_id, Success=True)
+
+    def MultiSet(self, request, context):
+        if not request.Pairs:
+            return raft_pb2.MultiSetReply(Success=True)
+        groups = {self.group_for_key(pair.key) for pair in request.Pairs}
+        for group in groups:
+            if group.state != LEADER:
+                return raft_pb2.MultiSetReply(LeaderID=str(group.current_leader), Success=False)
+        if request.Atomic:
+            if len(groups) > 1:
+                # Groups commit independently, so a batch cannot span them
+                return raft_pb2.MultiSetReply(LeaderID=str(self.node_id), Success=False)
+            return groups.pop().MultiSet(request, context)
+        replies = [self.group_for_key(pair.key).submit_set(pair.key, pair.value) for pair in request.Pairs]
+        results = [reply.result().Success for reply in replies]
+        return raft_pb2.MultiSetReply(Results=results, LeaderID=str(self.node_id), Success=all(results))
+
+    def ServeClientStream(self, request_iterator, context):
+        return serve_client_stream(self.submit_client_request, request_iterator, context)
+
+def serve_streams_on(servicer, thread_pool):
+    # A stream holds its thread for as long as it is open. gRPC runs a handler that carries an
+    # experimental_thread_pool on that pool instead of the server's, so open streams never take
+    # the threads serving AppendEntries and RequestVote.
+    for name in ("Watch", "ServeClientStream"):
+        handler = functools.partial(getattr(servicer, name))
+        handler.experimental_thread_pool = thread_pool
+        setattr(servicer, name, handler)
 
 def signal_handler(sig, frame):
     print("Received SIGINT signal. Exiting gracefully...")
     # Stop all timers
-    node.save_state()
-    node.cancel_election_timer()
-    node.cancel_heartbeat_timer()
-    node.cancel_lease_timer()
+    node.shutdown()
     sys.exit(0)
 
-def serve(node_id, node_addresses):
+def cluster_addresses(num_nodes, local=False):
+    if local:
+        return {i: f"localhost:{LOCAL_BASE_PORT + i}" for i in range(num_nodes)}
+    return {i: f"10.190.0.{i+2}:5005{i}" for i in range(num_nodes)}
+
+def serve(node_id, node_addresses, num_groups=1, learner_ids=()):
     global node  # Make the node object accessible to the signal_handler
-    node = RaftNode(node_id, node_addresses)
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    if num_groups > 1:
+        node = MultiRaftServer(node_id, node_addresses, num_groups, learner_ids)
+    else:
+        node = RaftNode(node_id, node_addresses, learner_ids=learner_ids)
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=SERVER_THREADS * num_groups))
+    serve_streams_on(node, futures.ThreadPoolExecutor(max_workers=STREAM_THREADS))
     raft_pb2_grpc.add_RaftServicer_to_server(node, server)
     server.add_insecure_port(node_addresses[node_id])
     server.start()
@@ -444,15 +1627,31 @@ def serve(node_id, node_addresses):
         print("Received keyboard interrupt. Exiting gracefully...")
         server.stop(0)
 
+def parse_options(argv):
+    # Splits --local and --learners=<id,id,...> off the positional arguments
+    local = False
+    learner_ids = ()
+    args = []
+    for arg in argv:
+        if arg == "--local":
+            local = True
+        elif arg.startswith("--learners="):
+            learner_ids = tuple(int(node_id) for node_id in arg.split("=", 1)[1].split(",") if node_id)
+        else:
+            args.append(arg)
+    return args, local, learner_ids
+
 def main():
-    if len(sys.argv) < 3:
-        print("Usage: python raft.py <node_id> <num_nodes>")
+    args, local, learner_ids = parse_options(sys.argv[1:])
+    if len(args) < 2:
+        print("Usage: python raft.py <node_id> <num_nodes> [num_groups] [--local] [--learners=<id,id,...>]")
         sys.exit(1)
-    node_id = int(sys.argv[1])
-    num_nodes = int(sys.argv[2])
-    node_addresses = {i: f"10.190.0.{i+2}:5005{i}" for i in range(num_nodes)}
+    node_id = int(args[0])
+    num_nodes = int(args[1])
+    num_groups = int(args[2]) if len(args) > 2 else 1
+    node_addresses = cluster_addresses(num_nodes, local)
     signal.signal(signal.SIGINT, signal_handler)
-    serve(node_id, node_addresses)
+    serve(node_id, node_addresses, num_groups, learner_ids)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,328 @@
+import grpc
+import raft_pb2
+import raft_pb2_grpc
+import asyncio
+import collections
+import sys
+from concurrent import futures
+from raft import (RaftNode, cluster_addresses, parse_options, LEADER, HEARTBEAT_INTERVAL, GROUP_COMMIT_MAX_BATCH,
+                  GROUP_COMMIT_MAX_DELAY, READ_INDEX_TIMEOUT, STREAM_MAX_IN_FLIGHT, CHANNEL_OPTIONS,
+                  TRANSFER_TIMEOUT, TRANSFER_POLL_INTERVAL, WATCH_PROGRESS_INTERVAL)
+from dump_logger import WARNING
+
+# Same node as raft.py, but every timer, peer RPC and client request runs on a single asyncio
+# event loop instead of a threading.Timer / threading.Thread each. The protocol logic is shared
+# with RaftNode, only the parts that block or start threads are replaced here.
+
+def wait_for_future(future):
+    # Awaits a concurrent future resolved by RaftNode. Shielded, so a cancelled RPC or an expired
+    # wait_for leaves the future alone: RaftNode still resolves it and would fail on a cancelled one.
+    return asyncio.shield(asyncio.wrap_future(future))
+
+class AsyncRaftNode(RaftNode):
+    def __init__(self, node_id, node_addresses, learner_ids=()):
+        self.loop = asyncio.get_running_loop()
+        self.write_event = asyncio.Event()
+        super().__init__(node_id, node_addresses, learner_ids=learner_ids)
+
+    def start_timer(self, delay, callback):
+        return self.loop.call_later(delay, callback)
+
+    def spawn(self, target, *args):
+        self.loop.create_task(target(*args))
+
+    def create_event(self):
+        return asyncio.Event()
+
+    def wait_for_log(self, index):
+        pass  # Requests are handled one at a time on the event loop, in the order they arrive
+
+    def get_stub(self, node_id):
+        stub = self.stubs.get(node_id)
+        if stub is None:
+            channel = grpc.aio.insecure_channel(self.node_addresses[node_id], options=CHANNEL_OPTIONS)
+            self.channels[node_id] = channel
+            stub = self.stubs[node_id] = raft_pb2_grpc.RaftStub(channel)
+        return stub
+
+    async def close_channels(self):
+        for channel in self.channels.values():
+            await channel.close()
+        self.channels = {}
+        self.stubs = {}
+
+    async def request_vote(self, node_id, request):
+        try:
+            response = await self.get_stub(node_id).RequestVote(request, timeout=1)
+        except grpc.RpcError as e:
+            self.write_to_dump_file(f"Error occurred while sending RPC to Node {node_id}.", WARNING)
+            return
+        self.handle_vote_reply(node_id, response)
+
+    async def replicator_loop(self, follower_id, term, event):
+        while self.state == LEADER and self.current_term == term:
+            try:
+                await asyncio.wait_for(event.wait(), HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                continue
+            event.clear()
+            if self.state != LEADER or self.current_term != term:
+                return
+            if await self.replicate_log(follower_id) and self.sent_length.get(follower_id, 0) < self.last_log_index():
+                event.set()
+
+    async def replicate_log(self, follower_id):
+        stub = self.get_stub(follower_id)
+        in_flight = collections.deque()
+        while self.state == LEADER:
+            for request in self.window_requests(follower_id, in_flight):
+                in_flight.append((request, stub.AppendEntries(request, timeout=1)))
+            if not in_flight:
+                return await self.send_snapshot(stub, follower_id)
+            request, call = in_flight.popleft()
+            try:
+                response = await call
+            except grpc.RpcError as e:
+                return self.window_failed(follower_id, request, in_flight)
+            done = self.handle_window_reply(follower_id, request, response, in_flight)
+            if done is not None:
+                return done
+        return False
+
+    async def write_snapshot(self, snapshot, data):
+        # Serializing and syncing a large state would stall the event loop, a worker thread does it
+        serialized = await self.loop.run_in_executor(None, self.store_snapshot, snapshot, data)
+        self.compact_log(snapshot, serialized)
+
+    async def send_snapshot(self, stub, follower_id):
+        requests = self.snapshot_requests()
+        if not requests:
+            return False
+        for request in requests:
+            try:
+                response = await stub.InstallSnapshot(request, timeout=5)
+            except grpc.RpcError as e:
+                return self.snapshot_failed(follower_id)
+            if not self.snapshot_chunk_accepted(response):
+                return False
+        self.snapshot_sent(follower_id, requests[-1].last_included_index)
+        return True
+
+    def submit_write(self, entry):
+        future = futures.Future()
+        self.pending_writes.append((entry, future))
+        self.write_event.set()
+        return future
+
+    async def group_commit_loop(self):
+        while True:
+            await self.write_event.wait()
+            if len(self.pending_writes) < GROUP_COMMIT_MAX_BATCH:
+                await asyncio.sleep(GROUP_COMMIT_MAX_DELAY)
+            batch = self.pending_writes[:GROUP_COMMIT_MAX_BATCH]
+            del self.pending_writes[:GROUP_COMMIT_MAX_BATCH]
+            if not self.pending_writes:
+                self.write_event.clear()
+            self.flush_group_commit(batch)
+
+    async def transfer_leadership_async(self, target_id=None):
+        target_id = self.start_transfer(target_id)
+        if target_id is None:
+            return False
+        term = self.current_term
+        deadline = self.now() + TRANSFER_TIMEOUT
+        try:
+            request = self.transfer_progress(target_id, term, deadline)
+            while request is None:
+                await asyncio.sleep(TRANSFER_POLL_INTERVAL)
+                request = self.transfer_progress(target_id, term, deadline)
+            if request is False:
+                return False
+            try:
+                await self.get_stub(target_id).TimeoutNow(request, timeout=1)
+            except grpc.RpcError as e:
+                return self.timeout_now_failed(target_id)
+            while not self.transfer_settled(target_id, deadline):
+                await asyncio.sleep(TRANSFER_POLL_INTERVAL)
+            return self.transfer_finished(target_id)
+        finally:
+            self.transfer_target = None
+
+    async def request_read_index_async(self):
+        leader_id = self.current_leader
+        if leader_id is None or leader_id == self.node_id:
+            return None
+        try:
+            response = await self.get_stub(leader_id).ReadIndex(raft_pb2.ReadIndexArgs(node_id=self.node_id), timeout=1)
+        except grpc.RpcError as e:
+            self.write_to_dump_file(f"Error occurred while sending ReadIndex RPC to Node {leader_id}.", WARNING)
+            return None
+        if not response.success:
+            return None
+        return response.read_index
+
+    async def can_serve_read_async(self, consistency, max_staleness):
+        if self.state != LEADER and consistency == raft_pb2.READ_INDEX:
+            read_index = await self.request_read_index_async()
+            if read_index is None:
+                return False
+            try:
+                return await asyncio.wait_for(wait_for_future(self.wait_for_commit(read_index)), READ_INDEX_TIMEOUT)
+            except asyncio.TimeoutError:
+                return False
+        return self.can_serve_read(consistency, max_staleness)
+
+    async def serve_client_request(self, request):
+        parts = request.Request.split()
+        if parts[0] == "SET" and self.state == LEADER:
+            return await wait_for_future(self.submit_set(parts[1], parts[2]))
+        if parts[0] == "GET" and await self.can_serve_read_async(request.Consistency, request.MaxStaleness):
+            value = self.read_value(parts[1])
+            return raft_pb2.ServeClientReply(Data=value, LeaderID=self.read_leader_id(), Success=True)
+        return raft_pb2.ServeClientReply(Data="", LeaderID=str(self.current_leader), Success=False)
+
+    async def RequestVote(self, request, context):
+        return super().RequestVote(request, context)
+
+    async def AppendEntries(self, request, context):
+        return super().AppendEntries(request, context)
+
+    async def InstallSnapshot(self, request, context):
+        return super().InstallSnapshot(request, context)
+
+    async def ReadIndex(self, request, context):
+        return super().ReadIndex(request, context)
+
+    async def TimeoutNow(self, request, context):
+        return super().TimeoutNow(request, context)
+
+    async def TransferLeadership(self, request, context):
+        target_id = int(request.TargetID) if request.TargetID else None
+        if self.state != LEADER or target_id == self.node_id:
+            return super().TransferLeadership(request, context)
+        success = await self.transfer_leadership_async(target_id)
+        return raft_pb2.TransferLeadershipReply(Success=success, LeaderID=str(self.current_leader))
+
+    async def GetMetrics(self, request, context):
+        return super().GetMetrics(request, context)
+
+    async def PromoteLearner(self, request, context):
+        # Checked and appended without awaiting in between, so no other promotion can slip in
+        reply = self.promotion_check(request.node_id)
+        if reply is not None:
+            return reply
+        index = await wait_for_future(self.submit_write(raft_pb2.LogEntry(operation="PROMOTE", key=str(request.node_id))))
+        committed = index is not None and await wait_for_future(self.wait_for_commit(index, leader_only=True))
+        if committed:
+            self.write_to_dump_file(f"Leader {self.node_id} promoted learner Node {request.node_id} to voter.")
+        return raft_pb2.PromoteLearnerReply(Success=committed, LeaderID=str(self.current_leader))
+
+    async def ServeClient(self, request, context):
+        return await self.serve_client_request(request)
+
+    async def MultiGet(self, request, context):
+        if not await self.can_serve_read_async(request.Consistency, request.MaxStaleness):
+            return raft_pb2.MultiGetReply(LeaderID=str(self.current_leader), Success=False)
+        return raft_pb2.MultiGetReply(Values=self.read_values(request.Keys), LeaderID=self.read_leader_id(), Success=True)
+
+    async def Scan(self, request, context):
+        if not await self.can_serve_read_async(request.Consistency, request.MaxStaleness):
+            yield raft_pb2.ScanReply(LeaderID=str(self.current_leader), Success=False)
+            return
+        for reply in self.scan_replies(request):
+            yield reply
+
+    async def Watch(self, request, context):
+        watcher, replies = self.start_watch(request)
+        try:
+            for reply in replies:
+                yield reply
+            while watcher is not None:
+                try:
+                    await asyncio.wait_for(watcher.changed.wait(), WATCH_PROGRESS_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                replies = self.watch_replies(watcher)
+                for reply in replies:
+                    yield reply
+                if not replies or watcher.compacted:
+                    return
+        finally:
+            if watcher is not None:
+                self.stop_watch(watcher)
+
+    async def MultiSet(self, request, context):
+        if self.state != LEADER:
+            return raft_pb2.MultiSetReply(LeaderID=str(self.current_leader), Success=False)
+        if request.Atomic:
+            reply = await wait_for_future(self.submit_batch(request.Pairs))
+            return raft_pb2.MultiSetReply(Results=[reply.Success] * len(request.Pairs), LeaderID=reply.LeaderID,
+                                          Success=reply.Success)
+        replies = [wait_for_future(self.submit_set(pair.key, pair.value)) for pair in request.Pairs]
+        results = [reply.Success for reply in await asyncio.gather(*replies)]
+        return raft_pb2.MultiSetReply(Results=results, LeaderID=str(self.node_id), Success=all(results))
+
+    async def ServeClientStream(self, request_iterator, context):
+        pending = asyncio.Queue(maxsize=STREAM_MAX_IN_FLIGHT)
+
+        async def submit_requests():
+            async for request in request_iterator:
+                if request.Request.startswith("SET"):
+                    await pending.put(wait_for_future(self.submit_client_request(request)))
+                    continue
+                # Later SETs wait until the GET has been evaluated, so it never sees them
+                evaluated = asyncio.Event()
+                await pending.put((request, evaluated))
+                await evaluated.wait()
+            await pending.put(None)
+
+        reader = self.loop.create_task(submit_requests())
+        try:
+            while True:
+                item = await pending.get()
+                if item is None:
+                    return
+                if isinstance(item, tuple):
+                    request, evaluated = item
+                    reply = await self.serve_client_request(request)
+                    evaluated.set()
+                    yield reply
+                else:
+                    yield await item
+        finally:
+            reader.cancel()
+
+async def serve(node_id, node_addresses, learner_ids=()):
+    node = AsyncRaftNode(node_id, node_addresses, learner_ids)
+    server = grpc.aio.server()
+    raft_pb2_grpc.add_RaftServicer_to_server(node, server)
+    server.add_insecure_port(node_addresses[node_id])
+    await server.start()
+    print(f"Node {node_id} started.")
+    node.start_election_timer()
+    try:
+        await server.wait_for_termination()
+    finally:
+        print("Exiting gracefully...")
+        if node.state == LEADER:
+            await node.transfer_leadership_async()
+        node.save_state()
+        node.wal.close()
+        await node.close_channels()
+        await server.stop(0)
+        node.dump_logger.close()
+
+def main():
+    args, local, learner_ids = parse_options(sys.argv[1:])
+    if len(args) < 2:
+        print("Usage: python raft_aio.py <node_id> <num_nodes> [--local] [--learners=<id,id,...>]")
+        sys.exit(1)
+    node_id = int(args[0])
+    num_nodes = int(args[1])
+    try:
+        asyncio.run(serve(node_id, cluster_addresses(num_nodes, local), learner_ids))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
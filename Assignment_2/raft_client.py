@@ -0,0 +1,397 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import grpc
+import queue
+import random
+import time
+import zlib
+import raft_pb2
+import raft_pb2_grpc
+from raft import CHANNEL_OPTIONS
+
+# Client library for the Raft key-value store, with a blocking RaftClient and an asyncio AsyncRaftClient.
+# Both keep one channel per node, remember the leader of every Raft group, probe all nodes in parallel
+# when the leader is unknown, follow LeaderID redirects and retry failed requests with backoff.
+# GET and SET are idempotent, so a request whose reply was lost is simply sent again.
+
+REQUEST_TIMEOUT = 30.0  # Time in seconds a request is retried before RaftClientError is raised
+RPC_TIMEOUT = 5.0  # Timeout in seconds of a single RPC
+TRANSFER_RPC_TIMEOUT = 15.0  # Timeout in seconds of a TransferLeadership RPC, which waits for the new leader
+PROBE_TIMEOUT = 1.0  # Timeout in seconds of a leader discovery probe
+RETRY_BACKOFF_MIN = 0.05  # First retry delay in seconds, doubled after every failed round
+RETRY_BACKOFF_MAX = 1.0  # Maximum retry delay in seconds
+
+
+class RaftClientError(Exception):
+    pass
+
+
+class BaseRaftClient:
+    def __init__(self, node_addresses, num_groups=1, timeout=REQUEST_TIMEOUT):
+        self.node_addresses = node_addresses
+        self.num_groups = num_groups
+        self.timeout = timeout
+        self.leaders = {}  # Raft group -> node id of its last known leader
+        self.channels = {}
+        self.stubs = {}
+        for node_id, address in node_addresses.items():
+            self.channels[node_id] = self.create_channel(address)
+            self.stubs[node_id] = raft_pb2_grpc.RaftStub(self.channels[node_id])
+
+    def group(self, key):
+        # Same routing as MultiRaftServer.group_for_key
+        return zlib.crc32(key.encode()) % self.num_groups
+
+    def leader_hint(self, reply, node_id):
+        # Node id named in a failed reply, if it is a node other than the one that sent it
+        if reply is None or not reply.LeaderID.isdigit() or int(reply.LeaderID) not in self.stubs:
+            return None
+        hint = int(reply.LeaderID)
+        return hint if hint != node_id else None
+
+    def first_node(self, key, consistency):
+        # Reads that do not need the leader are spread over all nodes
+        if consistency != raft_pb2.LINEARIZABLE:
+            return random.choice(list(self.stubs))
+        return self.leaders.get(self.group(key))
+
+    def probe_request(self, key):
+        return raft_pb2.ServeClientArgs(Request=f"GET {key}")
+
+    def discovered_leader(self, hints):
+        # Leader named by most nodes, used when no node answered the probe successfully
+        if not hints:
+            return None
+        return collections.Counter(hints).most_common(1)[0][0]
+
+    def key_in_group(self, group):
+        return next(f"__group_{i}__" for i in itertools.count() if self.group(f"__group_{i}__") == group)
+
+    def scan_request(self, start, end, limit, consistency, max_staleness, group):
+        return raft_pb2.ScanArgs(Start=start, End=end, Limit=limit, Consistency=consistency,
+                                 MaxStaleness=max_staleness, group_id=group)
+
+    def merge_scans(self, replies, limit):
+        # Every group returns its keys in order, merged they give the keys of the whole range in order
+        groups = [[(pair.key, pair.value) for pair in reply.Pairs] for reply in replies]
+        merged = list(heapq.merge(*groups))
+        return merged[:limit] if limit else merged
+
+    def grouped(self, keys):
+        groups = collections.defaultdict(list)
+        for key in keys:
+            groups[self.group(key)].append(key)
+        return groups
+
+    def watch_request(self, prefix, index, group):
+        # Until the first reply names a commit index, a watch started without one follows from now
+        return raft_pb2.WatchArgs(Prefix=prefix, FromIndex=index or 0, FromNow=index is None, group_id=group)
+
+    def watch_events(self, reply, index):
+        if reply.Compacted:
+            raise RaftClientError(f"The changes after index {index} were compacted, scan again and watch from a later index")
+        return [(event.Index, event.Key, event.Value) for event in reply.Events]
+
+    def atomic_grouped(self, pairs, atomic):
+        groups = list(self.grouped(pairs).values())
+        if atomic and len(groups) > 1:
+            raise ValueError("The keys of an atomic multi_set must all belong to one Raft group")
+        return groups
+
+
+class RaftClient(BaseRaftClient):
+    def create_channel(self, address):
+        return grpc.insecure_channel(address, options=CHANNEL_OPTIONS)
+
+    def close(self):
+        for channel in self.channels.values():
+            channel.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def discover_leader(self, key):
+        # Sends a probe to every node at once and returns the first node that answers as leader
+        request = self.probe_request(key)
+        done = queue.Queue()
+        calls = {}
+        for node_id, stub in self.stubs.items():
+            calls[node_id] = stub.ServeClient.future(request, timeout=PROBE_TIMEOUT)
+            calls[node_id].add_done_callback(lambda call, node_id=node_id: done.put((node_id, call)))
+        hints = []
+        for _ in calls:
+            node_id, call = done.get()
+            try:
+                reply = call.result()
+            except (grpc.RpcError, grpc.FutureCancelledError):
+                continue
+            if reply.Success:
+                for other in calls.values():
+                    other.cancel()
+                self.leaders[self.group(key)] = node_id
+                return node_id
+            hint = self.leader_hint(reply, None)
+            if hint is not None:
+                hints.append(hint)
+        return self.discovered_leader(hints)
+
+    def call(self, key, send, consistency=raft_pb2.LINEARIZABLE):
+        # Calls send(stub) on the leader of the key's group until it returns a successful reply. Each round
+        # starts at the known leader or, if there is none, at the one found by discover_leader, and the
+        # client only backs off once a whole round including its redirects has failed.
+        group = self.group(key)
+        deadline = time.time() + self.timeout
+        backoff = RETRY_BACKOFF_MIN
+        node_id = self.first_node(key, consistency)
+        while True:
+            if node_id is None:
+                node_id = self.discover_leader(key)
+            redirects = 0
+            while node_id is not None and redirects <= len(self.stubs):
+                try:
+                    reply = send(self.stubs[node_id])
+                except grpc.RpcError:
+                    reply = None
+                if reply is not None and reply.Success:
+                    if consistency == raft_pb2.LINEARIZABLE:
+                        self.leaders[group] = node_id
+                    return reply
+                node_id = self.leader_hint(reply, node_id)
+                redirects += 1
+            self.leaders.pop(group, None)
+            if time.time() + backoff > deadline:
+                raise RaftClientError(f"Request for key {key} did not succeed within {self.timeout}s")
+            time.sleep(backoff * random.uniform(0.5, 1.0))
+            backoff = min(backoff * 2, RETRY_BACKOFF_MAX)
+
+    def get(self, key, consistency=raft_pb2.LINEARIZABLE, max_staleness=0):
+        request = raft_pb2.ServeClientArgs(Request=f"GET {key}", Consistency=consistency, MaxStaleness=max_staleness)
+        return self.call(key, lambda stub: stub.ServeClient(request, timeout=RPC_TIMEOUT), consistency).Data
+
+    def set(self, key, value):
+        request = raft_pb2.ServeClientArgs(Request=f"SET {key} {value}")
+        self.call(key, lambda stub: stub.ServeClient(request, timeout=RPC_TIMEOUT))
+
+    def execute(self, command):
+        # Runs a "GET <key>" or "SET <key> <value>" command and returns the ServeClientReply
+        parts = command.split()
+        if len(parts) < 2 or parts[0] not in ("GET", "SET") or (parts[0] == "SET" and len(parts) < 3):
+            raise ValueError(f"Invalid command: {command}")
+        request = raft_pb2.ServeClientArgs(Request=command)
+        return self.call(parts[1], lambda stub: stub.ServeClient(request, timeout=RPC_TIMEOUT))
+
+    def scan(self, start, end="", limit=0, consistency=raft_pb2.LINEARIZABLE, max_staleness=0):
+        # Returns the (key, value) pairs with start <= key < end in key order
+        replies = []
+        for group in range(self.num_groups):
+            request = self.scan_request(start, end, limit, consistency, max_staleness, group)
+            replies.append(self.call(self.key_in_group(group), lambda stub: read_scan(stub.Scan(request, timeout=RPC_TIMEOUT)),
+                                     consistency))
+        return self.merge_scans(replies, limit)
+
+    def transfer_leadership(self, target_id, group=0):
+        # Retried until target_id is the leader of the group
+        request = raft_pb2.TransferLeadershipArgs(TargetID=str(target_id), group_id=group)
+        self.call(self.key_in_group(group), lambda stub: stub.TransferLeadership(request, timeout=TRANSFER_RPC_TIMEOUT))
+        self.leaders[group] = target_id
+
+    def watch(self, prefix="", from_index=None, group=0):
+        # Yields (index, key, value) for every SET of a key starting with prefix committed after
+        # from_index (None for after the current commit index) in the group. Any node can serve the
+        # watch, if it fails the watch is resumed on another node from the last index seen.
+        index = from_index
+        deadline = time.time() + self.timeout
+        backoff = RETRY_BACKOFF_MIN
+        while True:
+            request = self.watch_request(prefix, index, group)
+            try:
+                for reply in random.choice(list(self.stubs.values())).Watch(request):
+                    yield from self.watch_events(reply, index)
+                    index = reply.CommitIndex
+                    deadline = time.time() + self.timeout
+                    backoff = RETRY_BACKOFF_MIN
+            except grpc.RpcError:
+                pass
+            if time.time() + backoff > deadline:
+                raise RaftClientError(f"Watch of prefix {prefix} could not be resumed within {self.timeout}s")
+            time.sleep(backoff * random.uniform(0.5, 1.0))
+            backoff = min(backoff * 2, RETRY_BACKOFF_MAX)
+
+    def promote_learner(self, node_id):
+        # Retried until the learner has caught up with the leader of every group and was promoted
+        for group in range(self.num_groups):
+            request = raft_pb2.PromoteLearnerArgs(node_id=node_id, group_id=group)
+            self.call(self.key_in_group(group), lambda stub: stub.PromoteLearner(request, timeout=RPC_TIMEOUT))
+
+    def multi_get(self, keys, consistency=raft_pb2.LINEARIZABLE, max_staleness=0):
+        values = {}
+        for group_keys in self.grouped(keys).values():
+            request = raft_pb2.MultiGetArgs(Keys=group_keys, Consistency=consistency, MaxStaleness=max_staleness)
+            reply = self.call(group_keys[0], lambda stub: stub.MultiGet(request, timeout=RPC_TIMEOUT), consistency)
+            values.update(zip(group_keys, reply.Values))
+        return [values[key] for key in keys]
+
+    def multi_set(self, pairs, atomic=False):
+        # With atomic set all pairs are committed as one log entry, so they must be in one Raft group
+        for group_keys in self.atomic_grouped(pairs, atomic):
+            request = raft_pb2.MultiSetArgs(Pairs=[raft_pb2.KeyValue(key=key, value=pairs[key]) for key in group_keys],
+                                            Atomic=atomic)
+            self.call(group_keys[0], lambda stub: stub.MultiSet(request, timeout=RPC_TIMEOUT))
+
+
+class AsyncRaftClient(BaseRaftClient):
+    def create_channel(self, address):
+        return grpc.aio.insecure_channel(address, options=CHANNEL_OPTIONS)
+
+    async def close(self):
+        for channel in self.channels.values():
+            await channel.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def discover_leader(self, key):
+        request = self.probe_request(key)
+
+        async def probe(node_id, stub):
+            try:
+                return node_id, await stub.ServeClient(request, timeout=PROBE_TIMEOUT)
+            except grpc.RpcError:
+                return node_id, None
+
+        tasks = [asyncio.ensure_future(probe(node_id, stub)) for node_id, stub in self.stubs.items()]
+        hints = []
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                node_id, reply = await next_done
+                if reply is not None and reply.Success:
+                    self.leaders[self.group(key)] = node_id
+                    return node_id
+                hint = self.leader_hint(reply, None)
+                if hint is not None:
+                    hints.append(hint)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return self.discovered_leader(hints)
+
+    async def call(self, key, send, consistency=raft_pb2.LINEARIZABLE):
+        group = self.group(key)
+        deadline = time.time() + self.timeout
+        backoff = RETRY_BACKOFF_MIN
+        node_id = self.first_node(key, consistency)
+        while True:
+            if node_id is None:
+                node_id = await self.discover_leader(key)
+            redirects = 0
+            while node_id is not None and redirects <= len(self.stubs):
+                try:
+                    reply = await send(self.stubs[node_id])
+                except grpc.RpcError:
+                    reply = None
+                if reply is not None and reply.Success:
+                    if consistency == raft_pb2.LINEARIZABLE:
+                        self.leaders[group] = node_id
+                    return reply
+                node_id = self.leader_hint(reply, node_id)
+                redirects += 1
+            self.leaders.pop(group, None)
+            if time.time() + backoff > deadline:
+                raise RaftClientError(f"Request for key {key} did not succeed within {self.timeout}s")
+            await asyncio.sleep(backoff * random.uniform(0.5, 1.0))
+            backoff = min(backoff * 2, RETRY_BACKOFF_MAX)
+
+    async def get(self, key, consistency=raft_pb2.LINEARIZABLE, max_staleness=0):
+        request = raft_pb2.ServeClientArgs(Request=f"GET {key}", Consistency=consistency, MaxStaleness=max_staleness)
+        reply = await self.call(key, lambda stub: stub.ServeClient(request, timeout=RPC_TIMEOUT), consistency)
+        return reply.Data
+
+    async def set(self, key, value):
+        request = raft_pb2.ServeClientArgs(Request=f"SET {key} {value}")
+        await self.call(key, lambda stub: stub.ServeClient(request, timeout=RPC_TIMEOUT))
+
+    async def scan(self, start, end="", limit=0, consistency=raft_pb2.LINEARIZABLE, max_staleness=0):
+        replies = await asyncio.gather(*[
+            self.call(self.key_in_group(group), lambda stub, group=group: read_scan_async(stub.Scan(
+                self.scan_request(start, end, limit, consistency, max_staleness, group), timeout=RPC_TIMEOUT)), consistency)
+            for group in range(self.num_groups)])
+        return self.merge_scans(replies, limit)
+
+    async def transfer_leadership(self, target_id, group=0):
+        request = raft_pb2.TransferLeadershipArgs(TargetID=str(target_id), group_id=group)
+        await self.call(self.key_in_group(group), lambda stub: stub.TransferLeadership(request, timeout=TRANSFER_RPC_TIMEOUT))
+        self.leaders[group] = target_id
+
+    async def watch(self, prefix="", from_index=None, group=0):
+        index = from_index
+        deadline = time.time() + self.timeout
+        backoff = RETRY_BACKOFF_MIN
+        while True:
+            request = self.watch_request(prefix, index, group)
+            try:
+                async for reply in random.choice(list(self.stubs.values())).Watch(request):
+                    for event in self.watch_events(reply, index):
+                        yield event
+                    index = reply.CommitIndex
+                    deadline = time.time() + self.timeout
+                    backoff = RETRY_BACKOFF_MIN
+            except grpc.RpcError:
+                pass
+            if time.time() + backoff > deadline:
+                raise RaftClientError(f"Watch of prefix {prefix} could not be resumed within {self.timeout}s")
+            await asyncio.sleep(backoff * random.uniform(0.5, 1.0))
+            backoff = min(backoff * 2, RETRY_BACKOFF_MAX)
+
+    async def promote_learner(self, node_id):
+        for group in range(self.num_groups):
+            request = raft_pb2.PromoteLearnerArgs(node_id=node_id, group_id=group)
+            await self.call(self.key_in_group(group), lambda stub: stub.PromoteLearner(request, timeout=RPC_TIMEOUT))
+
+    async def multi_get(self, keys, consistency=raft_pb2.LINEARIZABLE, max_staleness=0):
+        groups = list(self.grouped(keys).values())
+        replies = await asyncio.gather(*[
+            self.call(group_keys[0], lambda stub, group_keys=group_keys: stub.MultiGet(raft_pb2.MultiGetArgs(
+                Keys=group_keys, Consistency=consistency, MaxStaleness=max_staleness), timeout=RPC_TIMEOUT), consistency)
+            for group_keys in groups])
+        values = {}
+        for group_keys, reply in zip(groups, replies):
+            values.update(zip(group_keys, reply.Values))
+        return [values[key] for key in keys]
+
+    async def multi_set(self, pairs, atomic=False):
+        await asyncio.gather(*[
+            self.call(group_keys[0], lambda stub, group_keys=group_keys: stub.MultiSet(raft_pb2.MultiSetArgs(
+                Pairs=[raft_pb2.KeyValue(key=key, value=pairs[key]) for key in group_keys], Atomic=atomic),
+                timeout=RPC_TIMEOUT))
+            for group_keys in self.atomic_grouped(pairs, atomic)])
+
+
+def read_scan(stream):
+    # Collects a Scan stream into a single ScanReply
+    reply = raft_pb2.ScanReply()
+    for chunk in stream:
+        if not chunk.Success:
+            return chunk
+        reply.Pairs.extend(chunk.Pairs)
+        reply.LeaderID = chunk.LeaderID
+        reply.Success = True
+    return reply
+
+
+async def read_scan_async(stream):
+    reply = raft_pb2.ScanReply()
+    async for chunk in stream:
+        if not chunk.Success:
+            return chunk
+        reply.Pairs.extend(chunk.Pairs)
+        reply.LeaderID = chunk.LeaderID
+        reply.Success = True
+    return reply
@@ -0,0 +1,442 @@
+import argparse
+import asyncio
+import grpc
+import itertools
+import os
+import random
+import selectors
+import shutil
+import tempfile
+import time
+from concurrent import futures
+import raft_pb2
+import dump_logger
+from raft import LEADER, ELECTION_TIMEOUT_MAX
+from raft_aio import AsyncRaftNode
+from benchmark import percentile, print_histogram
+from dump_logger import DEBUG, INFO, WARNING
+
+# Runs randomized crash and partition scenarios against AsyncRaftNode without gRPC or real time
+# (see --help). Every node of a scenario shares one event loop whose clock only moves forward
+# when all of them are idle, and peer RPCs go through an in-memory network. A scenario covering
+# minutes of simulated time runs in a fraction of a second, and its seed replays it exactly.
+
+NETWORK_DELAY_MIN = 0.0005  # Minimum one-way delay of a message in simulated seconds
+NETWORK_DELAY_MAX = 0.005  # Maximum one-way delay of a message in simulated seconds
+CLIENT_ID = -1  # Network address of the simulated client, partitions never cut it off
+CLIENT_TIMEOUT = 1.0  # Time in seconds the client waits for a write before trying another node
+WRITE_INTERVAL = 0.25  # Time in seconds between two writes of the client
+FAULT_KINDS = ["crash_leader", "stop_leader", "isolate_leader", "partition", "crash_follower"]
+FAULT_GAP_MIN = 1.0  # Minimum time in seconds between writes resuming and the next fault
+FAULT_GAP_MAX = 5.0  # Maximum time in seconds between writes resuming and the next fault
+FAULT_DURATION_MIN = 1.0  # Minimum time in seconds before a crashed node restarts or a partition heals
+FAULT_DURATION_MAX = 20.0  # Maximum time in seconds before a crashed node restarts or a partition heals
+RECOVERY_TIMEOUT = 120.0  # A scenario fails if no write succeeds for this long after a fault is healed
+SETTLE_TIME = ELECTION_TIMEOUT_MAX * 2  # Time in seconds writes keep running after the last fault
+SIMULATION_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None  # Scenario data directories, in memory if possible
+MAX_REPORTED_FAILURES = 10  # Failed scenarios listed with their seed in the report
+LOG_LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING}
+
+
+class VirtualClockSelector(selectors.DefaultSelector):
+    # Never waits for I/O, there is none. When the loop would sleep until its next timer, the
+    # clock jumps to it instead.
+    def __init__(self):
+        super().__init__()
+        self.now = 0.0
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise RuntimeError("simulation deadlocked, nothing is scheduled")
+        self.now += timeout
+        return []
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self.clock = VirtualClockSelector()
+        super().__init__(self.clock)
+
+    def time(self):
+        return self.clock.now
+
+    def call_soon_threadsafe(self, callback, *args, context=None):
+        # Concurrent futures are only resolved on the loop's own thread, so the loop never has to be woken up
+        return self.call_soon(callback, *args, context=context)
+
+
+class SimulatedRpcError(grpc.RpcError):
+    # Raised in place of a gRPC error, RaftNode catches both the same way
+    pass
+
+
+class Network:
+    # Delivers RPCs between the nodes of one scenario after a random delay each way. A crashed node
+    # refuses calls right away, a message across a partition is lost and the call times out.
+    def __init__(self, nodes, rng):
+        self.nodes = nodes  # node_id -> running node
+        self.rng = rng
+        self.blocked = set()  # (source, target) pairs that cannot reach each other
+
+    def partition(self, *sides):
+        self.blocked = {(source, target) for side in sides for other in sides if other is not side
+                        for source in side for target in other}
+
+    def heal(self):
+        self.blocked = set()
+
+    def delay(self):
+        return self.rng.uniform(NETWORK_DELAY_MIN, NETWORK_DELAY_MAX)
+
+    async def call(self, source, target, method, request, timeout=None):
+        try:
+            return await asyncio.wait_for(self.deliver(source, target, method, request), timeout)
+        except asyncio.TimeoutError:
+            raise SimulatedRpcError(f"{method} from Node {source} to Node {target} timed out")
+
+    async def deliver(self, source, target, method, request):
+        await asyncio.sleep(self.delay())
+        if (source, target) in self.blocked:
+            await asyncio.get_running_loop().create_future()  # Never resolves
+        node = self.nodes.get(target)
+        if node is None:
+            raise SimulatedRpcError(f"Node {target} is down")
+        response = await getattr(node, method)(request, None)
+        await asyncio.sleep(self.delay())
+        if (target, source) in self.blocked:
+            await asyncio.get_running_loop().create_future()
+        return response
+
+
+class SimulatedStub:
+    # Stands in for raft_pb2_grpc.RaftStub, a call returns a task resolving to the reply
+    def __init__(self, node, target):
+        self.node = node
+        self.target = target
+
+    def __getattr__(self, method):
+        def call(request, timeout=None):
+            return self.node.track(self.node.simulation.network.call(self.node.node_id, self.target, method,
+                                                                     request, timeout), rpc=True)
+        return call
+
+
+class SimulatedNode(AsyncRaftNode):
+    # AsyncRaftNode on the virtual clock, talking to its peers over the simulated network. Crashing
+    # it cancels all of its work, and a restart is a new node loading the same data directory.
+    def __init__(self, node_id, simulation):
+        self.simulation = simulation
+        self.tasks = set()
+        self.crashed = False
+        super().__init__(node_id, simulation.addresses)
+        self.random = random.Random(simulation.rng.getrandbits(64))
+
+    def now(self):
+        return self.loop.time()
+
+    def start_timer(self, delay, callback):
+        return self.loop.call_later(delay, self.run_unless_crashed, callback)
+
+    def run_unless_crashed(self, callback):
+        if not self.crashed:
+            callback()
+
+    def spawn(self, target, *args):
+        return self.track(target(*args))
+
+    def track(self, coroutine, rpc=False):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(lambda task: self.task_done(task, rpc))
+        return task
+
+    def task_done(self, task, rpc):
+        self.tasks.discard(task)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None and not (rpc and isinstance(error, grpc.RpcError)):
+            self.simulation.fail(f"Node {self.node_id} raised {error!r}")
+
+    def get_stub(self, node_id):
+        stub = self.stubs.get(node_id)
+        if stub is None:
+            stub = self.stubs[node_id] = SimulatedStub(self, node_id)
+        return stub
+
+    def sync_wal(self):
+        pass  # A simulated crash loses the process but not the page cache, the WAL is already flushed to it
+
+    async def write_snapshot(self, snapshot, data):
+        # Written inline, a worker thread would finish at a point of virtual time that depends on real time
+        self.compact_log(snapshot, self.store_snapshot(snapshot, data))
+
+    def write_to_dump_file(self, message, level=INFO, sampled=False):
+        super().write_to_dump_file(f"[{self.now():.3f}s] {message}", level, sampled)
+
+    def become_leader(self):
+        self.simulation.leader_elected(self)
+        super().become_leader()
+
+    def crash(self):
+        self.crashed = True
+        for task in list(self.tasks):
+            task.cancel()
+        self.wal.close()
+        self.dump_logger.close()
+
+
+class Simulation:
+    # One scenario: a client writes a new key every write interval while faults are injected one
+    # after the other, each healed and followed by writes succeeding again before the next one
+    def __init__(self, seed, options):
+        self.seed = seed
+        self.options = options
+        self.rng = random.Random(seed)
+        self.loop = asyncio.get_running_loop()
+        self.addresses = {node_id: f"sim:{node_id}" for node_id in range(options.nodes)}
+        self.nodes = {}
+        self.network = Network(self.nodes, self.rng)
+        self.elections = []  # (time, term, node_id) of every election won
+        self.leaders = {}  # Term -> node that won it
+        self.acked = {}  # Writes the client got a success reply for, key -> value
+        self.write_times = []  # Time of every acknowledged write
+        self.write_acked = asyncio.Event()
+        self.last_writer = None  # Node that acknowledged the latest write
+        self.faults = []  # (kind, time, term of the leader if the fault cost it its quorum, else None)
+        self.errors = []
+
+    def fail(self, message):
+        self.errors.append(f"{self.loop.time():.3f}s: {message}")
+
+    def loop_exception(self, loop, context):
+        self.fail(f"{context['message']} {context.get('exception')!r}")
+
+    def start_node(self, node_id):
+        node = self.nodes[node_id] = SimulatedNode(node_id, self)
+        node.start_election_timer()
+
+    def crash_node(self, node_id):
+        self.nodes.pop(node_id).crash()
+
+    def leader(self):
+        leaders = [node for node in self.nodes.values() if node.state == LEADER]
+        return max(leaders, key=lambda node: node.current_term) if leaders else None
+
+    def leader_elected(self, node):
+        winner = self.leaders.setdefault(node.current_term, node.node_id)
+        if winner != node.node_id:
+            self.fail(f"Node {winner} and Node {node.node_id} both won term {node.current_term}")
+        self.elections.append((self.loop.time(), node.current_term, node.node_id))
+
+    async def client_loop(self):
+        target = None
+        for write_id in itertools.count():
+            if target is None or target not in self.addresses:
+                target = self.rng.choice(list(self.addresses))
+            key, value = f"key{write_id}", f"value{write_id}"
+            request = raft_pb2.ServeClientArgs(Request=f"SET {key} {value}")
+            try:
+                reply = await self.network.call(CLIENT_ID, target, "ServeClient", request, CLIENT_TIMEOUT)
+            except grpc.RpcError:
+                reply = None
+            if reply is not None and reply.Success:
+                self.acked[key] = value
+                self.write_times.append(self.loop.time())
+                self.last_writer = target
+                self.write_acked.set()
+            elif reply is not None and reply.LeaderID.isdigit() and int(reply.LeaderID) != target:
+                target = int(reply.LeaderID)
+            else:
+                target = None
+            await asyncio.sleep(self.options.write_interval)
+
+    async def wait_for_write(self, since):
+        deadline = self.loop.time() + RECOVERY_TIMEOUT
+        while not self.write_times or self.write_times[-1] <= since:
+            self.write_acked.clear()
+            try:
+                await asyncio.wait_for(self.write_acked.wait(), deadline - self.loop.time())
+            except asyncio.TimeoutError:
+                self.fail(f"no write succeeded within {RECOVERY_TIMEOUT:.0f}s")
+                return False
+        return True
+
+    async def inject_fault(self):
+        kind = self.rng.choice(self.options.faults)
+        start = self.loop.time()
+        leader = self.leader()
+        leader_id = leader.node_id if leader is not None else self.rng.choice(list(self.nodes))
+        lost_term = leader.current_term if leader is not None else None
+        target = leader_id
+        if kind == "crash_follower":
+            target = self.rng.choice([node_id for node_id in self.nodes if node_id != leader_id])
+            lost_term = None
+        if kind == "stop_leader":
+            await self.nodes[target].transfer_leadership_async()
+        if kind in ("crash_leader", "stop_leader", "crash_follower"):
+            self.crash_node(target)
+        elif kind == "isolate_leader":
+            self.network.partition([target], [node_id for node_id in self.addresses if node_id != target])
+        else:
+            node_ids = list(self.addresses)
+            self.rng.shuffle(node_ids)
+            sides = [node_ids[:self.rng.randint(1, len(node_ids) // 2)]]
+            sides.append(node_ids[len(sides[0]):])
+            self.network.partition(*sides)
+            if any(leader_id in side and len(side) > len(node_ids) // 2 for side in sides):
+                lost_term = None
+        self.faults.append((kind, start, lost_term))
+        await asyncio.sleep(self.rng.uniform(FAULT_DURATION_MIN, FAULT_DURATION_MAX))
+        if target not in self.nodes:
+            self.start_node(target)
+        self.network.heal()
+        return await self.wait_for_write(self.loop.time())
+
+    def check_writes(self):
+        # The node that acknowledged the last write has applied every write acknowledged before it
+        node = self.nodes.get(self.last_writer)
+        missing = [key for key, value in self.acked.items() if node is None or node.data_store.get(key) != value]
+        if missing:
+            self.fail(f"{len(missing)} acknowledged writes are missing on Node {self.last_writer}, "
+                      f"the first is {missing[0]}")
+
+    async def run(self):
+        self.loop.set_exception_handler(self.loop_exception)
+        for node_id in self.addresses:
+            self.start_node(node_id)
+        client = self.loop.create_task(self.client_loop())
+        startup = None
+        try:
+            if await self.wait_for_write(0):
+                startup = self.write_times[0]
+                for _ in range(self.rng.randint(1, self.options.max_faults)):
+                    await asyncio.sleep(self.rng.uniform(FAULT_GAP_MIN, FAULT_GAP_MAX))
+                    if not await self.inject_fault():
+                        break
+                else:
+                    await asyncio.sleep(SETTLE_TIME)
+                    self.check_writes()
+        finally:
+            end = self.loop.time()
+            client.cancel()
+            for node_id in list(self.nodes):
+                self.crash_node(node_id)
+            pending = asyncio.all_tasks() - {asyncio.current_task()}
+            if pending:
+                await asyncio.wait(pending, timeout=CLIENT_TIMEOUT)
+        return {
+            "seed": self.seed,
+            "startup": startup,
+            "faults": self.fault_results(end),
+            "elections": len(self.elections),
+            "simulated": end,
+            "errors": self.errors,
+        }
+
+    def fault_results(self, end):
+        # (kind, leader lost, election convergence, write unavailability) of every fault. Each fault is
+        # measured until the next one, so an election forced by a node that rejoins is counted as well.
+        results = []
+        window_ends = [start for kind, start, lost_term in self.faults[1:]] + [end]
+        for (kind, start, lost_term), window_end in zip(self.faults, window_ends):
+            convergence = None
+            if lost_term is not None:
+                convergence = next((elected - start for elected, term, node_id in self.elections
+                                    if start < elected <= window_end and term > lost_term), None)
+            writes = [start] + [acked for acked in self.write_times if start < acked <= window_end] + [window_end]
+            unavailability = max(later - earlier for earlier, later in zip(writes, writes[1:]))
+            results.append((kind, lost_term is not None, convergence, unavailability))
+        return results
+
+
+async def simulate(seed, options):
+    return await Simulation(seed, options).run()
+
+
+def run_scenario(seed, options):
+    # The nodes keep their data under the working directory, every scenario gets a fresh one
+    dump_logger.DUMP_TO_STDOUT = False
+    dump_logger.DUMP_LOG_LEVEL = LOG_LEVELS[options.log_level]
+    directory = tempfile.mkdtemp(prefix=f"raft_simulation_{seed}_", dir=SIMULATION_DIR)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    loop = VirtualClockLoop()
+    try:
+        result = loop.run_until_complete(simulate(seed, options))
+    finally:
+        loop.close()
+        os.chdir(cwd)
+        if not options.keep_logs:
+            shutil.rmtree(directory, ignore_errors=True)
+    return result
+
+
+def describe(title, values, histogram=True):
+    if not values:
+        print(f"{title}: no samples")
+        return
+    values.sort()
+    print(f"{title}: {len(values)} samples, p50 {percentile(values, 0.5):.2f}s, p90 {percentile(values, 0.9):.2f}s, "
+          f"p99 {percentile(values, 0.99):.2f}s, max {values[-1]:.2f}s")
+    if histogram:
+        print_histogram(values)
+
+
+def report(results, elapsed, options):
+    faults = [fault for result in results for fault in result["faults"]]
+    simulated = sum(result["simulated"] for result in results)
+    print(f"Ran {len(results)} scenarios ({options.nodes} nodes, {len(faults)} faults, "
+          f"{sum(result['elections'] for result in results)} elections) in {elapsed:.1f}s: "
+          f"{len(results) / elapsed * 60:.0f} scenarios/min, {simulated:.0f} simulated seconds "
+          f"({simulated / elapsed:.0f}x real time)")
+    describe("First write after a cold start", [result["startup"] for result in results if result["startup"] is not None])
+    losses = [convergence for kind, lost, convergence, unavailability in faults if lost]
+    convergences = [convergence for convergence in losses if convergence is not None]
+    describe(f"Election convergence after the leader lost its quorum ({len(losses) - len(convergences)} of "
+             f"{len(losses)} healed before a new leader was elected)", convergences)
+    describe("Write unavailability, the longest gap between acknowledged writes after a fault",
+             [unavailability for kind, lost, convergence, unavailability in faults])
+    for kind in options.faults:
+        describe(f"    {kind}", [unavailability for fault_kind, lost, convergence, unavailability in faults
+                                 if fault_kind == kind], histogram=False)
+    failures = [result for result in results if result["errors"]]
+    print(f"{len(failures)} scenarios failed")
+    for result in failures[:MAX_REPORTED_FAILURES]:
+        print(f"    seed {result['seed']}: {result['errors'][0]}")
+    if failures:
+        print("Replay a scenario with --seed <seed> --scenarios 1 --keep-logs --log-level debug")
+    if options.keep_logs:
+        print(f"Data directories and dump files kept in {SIMULATION_DIR or tempfile.gettempdir()}/raft_simulation_<seed>_*")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run randomized crash and partition scenarios against simulated "
+                                                 "Raft clusters on a virtual clock.")
+    parser.add_argument("--scenarios", type=int, default=1000, help="number of scenarios to run")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the first scenario, the others count up from it")
+    parser.add_argument("--nodes", type=int, default=3, help="number of nodes in every cluster")
+    parser.add_argument("--max-faults", type=int, default=3, help="maximum number of faults in a scenario")
+    parser.add_argument("--fault", dest="faults", action="append", choices=FAULT_KINDS,
+                        help="fault to inject, can be repeated (default: all of them)")
+    parser.add_argument("--write-interval", type=float, default=WRITE_INTERVAL,
+                        help="simulated seconds between client writes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of processes running scenarios")
+    parser.add_argument("--log-level", default="warning", choices=sorted(LOG_LEVELS), help="level of the dump files")
+    parser.add_argument("--keep-logs", action="store_true", help="keep the data directories and dump files")
+    args = parser.parse_args()
+    if args.nodes < 3:
+        parser.error("--nodes must be at least 3")
+    args.faults = args.faults or FAULT_KINDS
+
+    seeds = range(args.seed, args.seed + args.scenarios)
+    start = time.time()
+    if args.workers > 1:
+        with futures.ProcessPoolExecutor(args.workers) as executor:
+            results = list(executor.map(run_scenario, seeds, itertools.repeat(args), chunksize=16))
+    else:
+        results = [run_scenario(seed, args) for seed in seeds]
+    report(results, time.time() - start, args)
+
+if __name__ == "__main__":
+    main()
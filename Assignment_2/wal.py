@@ -0,0 +1,182 @@
+import os
+import struct
+import zlib
+
+WAL_SEGMENT_SIZE = 4 * 1024 * 1024  # Roll over to a new segment file after this many bytes
+
+# Segments start with SEGMENT_MAGIC. Every record is <index, term, payload length, crc32> followed
+# by a serialized LogEntry, the checksum covering the first three fields and the payload. With the
+# index and term in the header, recovery finds and loads entries without parsing them.
+SEGMENT_MAGIC = b"RAFTWAL1"
+RECORD_HEADER = struct.Struct("<QiII")
+RECORD_FIELDS = struct.Struct("<QiI")
+SEGMENT_SUFFIX = ".seg"
+
+
+def record_crc(index, term, payload):
+    return zlib.crc32(payload, zlib.crc32(RECORD_FIELDS.pack(index, term, len(payload))))
+
+
+class WriteAheadLog:
+    def __init__(self, directory, segment_size=WAL_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(self.directory, exist_ok=True)
+        self.segments = self.list_segments()
+        self.active_file = None
+
+    def segment_path(self, first_index):
+        return os.path.join(self.directory, f"{first_index:020d}{SEGMENT_SUFFIX}")
+
+    def list_segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                segments.append(int(name[:-len(SEGMENT_SUFFIX)]))
+        return sorted(segments)
+
+    def segment_intact(self, first_index):
+        # A segment whose magic was torn by a crash holds no records
+        with open(self.segment_path(first_index), "rb") as f:
+            return f.read(len(SEGMENT_MAGIC)) == SEGMENT_MAGIC
+
+    def read_segment(self, first_index, after_index=0):
+        # Yields (index, term, offset, end, payload) for every intact record in the segment, the
+        # payload being a memoryview. Records up to after_index are skipped without being checked.
+        # Reading stops at the first torn or corrupt record.
+        with open(self.segment_path(first_index), "rb") as f:
+            data = memoryview(f.read())
+        if data[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+            return
+        offset = len(SEGMENT_MAGIC)
+        while offset + RECORD_HEADER.size <= len(data):
+            index, term, length, crc = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length:
+                break
+            if index > after_index and crc != record_crc(index, term, payload):
+                break
+            yield index, term, offset, start + length, payload
+            offset = start + length
+
+    def load(self, after_index=0):
+        # Returns the terms and serialized entries of the contiguous run of entries that follow
+        # after_index. Segments that only hold earlier entries are not read at all.
+        terms = []
+        payloads = []
+        for position, first_index in enumerate(self.segments):
+            following = self.segments[position + 1] if position + 1 < len(self.segments) else None
+            if following is not None and following <= after_index + 1:
+                continue
+            valid_end = len(SEGMENT_MAGIC) if self.segment_intact(first_index) else 0
+            for index, term, offset, end, payload in self.read_segment(first_index, after_index):
+                if index == after_index + len(payloads) + 1:
+                    terms.append(term)
+                    payloads.append(bytes(payload))
+                valid_end = end
+            path = self.segment_path(first_index)
+            if valid_end < os.path.getsize(path):
+                # Drop a partially written tail left behind by a crash
+                with open(path, "r+b") as f:
+                    f.truncate(valid_end)
+                for later in self.segments[position + 1:]:
+                    os.remove(self.segment_path(later))
+                self.segments = self.segments[:position + 1]
+                break
+        return terms, payloads
+
+    def open_active_segment(self, next_index):
+        if self.active_file is not None and self.active_file.tell() < self.segment_size:
+            return self.active_file
+        if self.active_file is not None:
+            self.active_file.close()
+            self.active_file = None
+        last = self.segments[-1] if self.segments else None
+        if last is not None and len(SEGMENT_MAGIC) <= os.path.getsize(self.segment_path(last)) < self.segment_size:
+            self.active_file = open(self.segment_path(last), "ab")
+            return self.active_file
+        # A last segment named next_index holds no entries (at most a torn magic), so it is rewritten
+        if last != next_index:
+            self.segments.append(next_index)
+        self.active_file = open(self.segment_path(next_index), "wb")
+        self.active_file.write(SEGMENT_MAGIC)
+        return self.active_file
+
+    def append(self, start_index, terms, payloads):
+        # payloads are the serialized LogEntry messages starting at start_index, terms their terms
+        if not payloads:
+            return
+        f = self.open_active_segment(start_index)
+        records = []
+        for i, (term, payload) in enumerate(zip(terms, payloads)):
+            index = start_index + i
+            records.append(RECORD_HEADER.pack(index, term, len(payload), record_crc(index, term, payload)))
+            records.append(payload)
+        f.write(b"".join(records))
+        f.flush()
+
+    def sync(self):
+        if self.active_file is not None:
+            self.active_file.flush()
+            os.fsync(self.active_file.fileno())
+
+    def truncate(self, length):
+        # Discard every entry with index > length
+        if self.active_file is not None:
+            self.active_file.close()
+            self.active_file = None
+        while self.segments and self.segments[-1] > length:
+            os.remove(self.segment_path(self.segments.pop()))
+        if not self.segments:
+            return
+        last = self.segments[-1]
+        for index, term, offset, end, payload in self.read_segment(last):
+            if index > length:
+                with open(self.segment_path(last), "r+b") as f:
+                    f.truncate(offset)
+                break
+
+    def compact(self, index):
+        # Removes segments whose entries are all covered by a snapshot up to index
+        while len(self.segments) > 1 and self.segments[1] <= index + 1:
+            os.remove(self.segment_path(self.segments.pop(0)))
+
+    def size(self):
+        return sum(os.path.getsize(self.segment_path(first_index)) for first_index in self.segments)
+
+    def close(self):
+        if self.active_file is not None:
+            self.active_file.close()
+            self.active_file = None
+
+
+def write_file(path, data, sync=False):
+    with open(path, "wb") as f:
+        f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def sync_directory(path):
+    # A rename is only durable once the directory holding the file is synced
+    dir_fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def atomic_write(path, data, sync=False):
+    # Written to a temporary file and renamed so a crash never leaves a half written file
+    tmp_path = path + ".tmp"
+    write_file(tmp_path, data, sync)
+    os.replace(tmp_path, path)
+    if sync:
+        sync_directory(path)
+
+
+def save_metadata(path, metadata, sync=False):
+    lines = [f"{key}: {value if value is not None else ''}\n" for key, value in metadata.items()]
+    atomic_write(path, "".join(lines).encode(), sync)